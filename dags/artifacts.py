@@ -0,0 +1,119 @@
+import gzip
+import json
+import os
+
+from decimal import Decimal
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Campos grandes do payload do Spotify que nenhuma etapa da DAG utiliza
+DROPPED_FIELDS = ('available_markets',)
+
+
+def slim(value):
+
+    """
+    Remove recursivamente os campos de DROPPED_FIELDS do payload.
+    """
+
+    if isinstance(value, dict):
+        return {k: slim(v) for k, v in value.items() if k not in DROPPED_FIELDS}
+
+    if isinstance(value, list):
+        return [slim(v) for v in value]
+
+    return value
+
+
+def json_default(value):
+
+    # Números vindos do TypeDeserializer do DynamoDB chegam como Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+
+    raise TypeError(f'Objeto do tipo {type(value).__name__} não é serializável em JSON')
+
+
+def encode_records(records, compression):
+
+    body = '\n'.join(
+        json.dumps(slim(record), separators=(',', ':'), default=json_default) for record in records
+    ).encode()
+
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Compressão zstd requer o pacote zstandard')
+        return zstandard.ZstdCompressor().compress(body)
+
+    return gzip.compress(body)
+
+
+def decode_records(data, compression):
+
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Compressão zstd requer o pacote zstandard')
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = gzip.decompress(data)
+
+    return [json.loads(line) for line in data.decode().splitlines() if line]
+
+
+def write_artifact(records, uri, name, s3_client=None, compression='gzip'):
+
+    """
+    Grava os registros como JSONL comprimido em um diretório local ou em um prefixo
+    s3://bucket/prefixo e retorna a referência pequena que vai para o XCom.
+    """
+
+    extension = 'zst' if compression == 'zstd' else 'gz'
+    location = f'{uri.rstrip("/")}/{name}.jsonl.{extension}'
+    data = encode_records(records, compression)
+
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        s3_client.put_object(Bucket=bucket, Key=key, Body=data)
+    else:
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location, 'wb') as f:
+            f.write(data)
+
+    return {'location': location, 'compression': compression, 'count': len(records)}
+
+
+def read_artifact(ref, s3_client=None):
+
+    """
+    Lê os registros a partir da referência devolvida por write_artifact.
+    """
+
+    location = ref['location']
+
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        data = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    else:
+        with open(location, 'rb') as f:
+            data = f.read()
+
+    return decode_records(data, ref['compression'])
+
+
+def delete_artifact(ref, s3_client=None):
+
+    """
+    Remove o artefato apontado pela referência, se ele ainda existir.
+    """
+
+    location = ref['location']
+
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        s3_client.delete_object(Bucket=bucket, Key=key)
+    elif os.path.exists(location):
+        os.remove(location)
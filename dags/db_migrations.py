@@ -0,0 +1,227 @@
+import argparse
+import os
+
+#+-------------------------------------------------------------------------+
+#|              MIGRAÇÕES VERSIONADAS DO BANCO POSTGRES                    |
+#+-------------------------------------------------------------------------+
+
+# (versão, descrição, SQL). Novas migrações entram sempre no fim da lista.
+MIGRATIONS = [
+    (
+        1,
+        'schema inicial',
+        """
+            CREATE TABLE IF NOT EXISTS artist (
+                artist_id   TEXT PRIMARY KEY,
+                name        TEXT NOT NULL,
+                image_url   TEXT,
+                popularity  INTEGER,
+                followers   BIGINT
+            );
+
+            CREATE TABLE IF NOT EXISTS album (
+                album_id      TEXT PRIMARY KEY,
+                name          TEXT,
+                release_date  DATE,
+                total_tracks  INTEGER,
+                album_type    TEXT,
+                image_url     TEXT
+            );
+
+            CREATE TABLE IF NOT EXISTS track (
+                track_id          TEXT PRIMARY KEY,
+                name              TEXT NOT NULL,
+                duration_ms       INTEGER,
+                uri               TEXT,
+                album_id          TEXT REFERENCES album (album_id),
+                explicit          BOOLEAN,
+                popularity        INTEGER,
+                acousticness      REAL,
+                danceability      REAL,
+                energy            REAL,
+                instrumentalness  REAL,
+                liveness          REAL,
+                speechiness       REAL,
+                valence           REAL,
+                tempo             REAL
+            );
+
+            CREATE TABLE IF NOT EXISTS track_artist (
+                track_id   TEXT REFERENCES track (track_id),
+                artist_id  TEXT REFERENCES artist (artist_id),
+                PRIMARY KEY (track_id, artist_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS playback_history (
+                id            BIGSERIAL PRIMARY KEY,
+                track_id      TEXT REFERENCES track (track_id),
+                played_at     TIMESTAMPTZ NOT NULL UNIQUE,
+                playback_sec  REAL,
+                was_played    BOOLEAN,
+                popularity    INTEGER
+            );
+        """
+    ),
+    (
+        2,
+        'índices das consultas do dashboard',
+        """
+            -- Range scans por período; o INCLUDE permite index-only scans nos agregados
+            CREATE INDEX IF NOT EXISTS idx_playback_history_played_at
+                ON playback_history (played_at) INCLUDE (track_id, playback_sec, was_played);
+
+            CREATE INDEX IF NOT EXISTS idx_playback_history_track_id
+                ON playback_history (track_id);
+
+            CREATE INDEX IF NOT EXISTS idx_track_artist_artist_track
+                ON track_artist (artist_id, track_id);
+
+            CREATE INDEX IF NOT EXISTS idx_artist_name
+                ON artist (name);
+
+            CREATE INDEX IF NOT EXISTS idx_track_album_id
+                ON track (album_id);
+        """
+    ),
+    (
+        3,
+        'rollups diários',
+        """
+            CREATE TABLE IF NOT EXISTS daily_track (
+                day       DATE NOT NULL,
+                track_id  TEXT NOT NULL REFERENCES track (track_id),
+                seconds   DOUBLE PRECISION NOT NULL,
+                plays     INTEGER NOT NULL,
+                skips     INTEGER NOT NULL,
+                PRIMARY KEY (day, track_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS daily_artist (
+                day        DATE NOT NULL,
+                artist_id  TEXT NOT NULL REFERENCES artist (artist_id),
+                seconds    DOUBLE PRECISION NOT NULL,
+                plays      INTEGER NOT NULL,
+                PRIMARY KEY (day, artist_id)
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_daily_track_track_id ON daily_track (track_id);
+            CREATE INDEX IF NOT EXISTS idx_daily_artist_artist_id ON daily_artist (artist_id);
+
+            -- Backfill com todo o histórico, na mesma transação que registra a versão:
+            -- se falhar, a migração inteira é refeita na próxima execução
+            INSERT INTO daily_track (day, track_id, seconds, plays, skips)
+            SELECT ph.played_at::date,
+                   ph.track_id,
+                   COALESCE(SUM(ph.playback_sec), 0),
+                   COUNT(*),
+                   COUNT(*) FILTER (WHERE ph.was_played = FALSE)
+            FROM playback_history ph
+            GROUP BY ph.played_at::date, ph.track_id
+            ON CONFLICT (day, track_id) DO NOTHING;
+
+            INSERT INTO daily_artist (day, artist_id, seconds, plays)
+            SELECT ph.played_at::date,
+                   ta.artist_id,
+                   COALESCE(SUM(ph.playback_sec), 0),
+                   COUNT(*)
+            FROM playback_history ph
+                JOIN track_artist ta ON ta.track_id = ph.track_id
+            GROUP BY ph.played_at::date, ta.artist_id
+            ON CONFLICT (day, artist_id) DO NOTHING;
+        """
+    ),
+    (
+        4,
+        'registro de cargas',
+        """
+            -- Uma linha por carga do insert_into_postgres; o dashboard usa MAX(load_id)
+            -- como versão dos dados para invalidar o cache de consultas
+            CREATE TABLE IF NOT EXISTS pipeline_load (
+                load_id        BIGSERIAL PRIMARY KEY,
+                loaded_at      TIMESTAMPTZ NOT NULL DEFAULT now(),
+                rows           INTEGER NOT NULL,
+                max_played_at  TIMESTAMPTZ
+            );
+        """
+    ),
+    (
+        5,
+        'refresh por artista',
+        """
+            -- Momento da última busca do artista na API; o TTL do cache vale por artista
+            ALTER TABLE artist ADD COLUMN IF NOT EXISTS refreshed_at TIMESTAMPTZ;
+
+            CREATE INDEX IF NOT EXISTS idx_artist_refreshed_at
+                ON artist (refreshed_at NULLS FIRST);
+        """
+    ),
+]
+
+
+def apply_migrations(conn):
+
+    """
+    Aplica, em ordem e cada uma em sua própria transação, as migrações ainda não
+    registradas em schema_migrations. Retorna as versões aplicadas.
+    """
+
+    cursor = conn.cursor()
+
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version     INTEGER PRIMARY KEY,
+                name        TEXT NOT NULL,
+                applied_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """
+    )
+    conn.commit()
+
+    cursor.execute("SELECT version FROM schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+
+    new_versions = []
+
+    for version, name, sql in MIGRATIONS:
+
+        if version in applied:
+            continue
+
+        cursor.execute(sql)
+        cursor.execute(
+            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+            (version, name)
+        )
+        conn.commit()
+
+        print(f'[INFO] Migração {version} aplicada: {name}')
+        new_versions.append(version)
+
+    cursor.close()
+
+    return new_versions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Aplica as migrações do banco do Spotify Wrapped')
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'),
+                        help='string de conexão do Postgres (padrão: $DATABASE_URL)')
+    args = parser.parse_args()
+
+    import psycopg2
+
+    conn = psycopg2.connect(args.dsn)
+
+    try:
+        applied = apply_migrations(conn)
+    finally:
+        conn.close()
+
+    print(f'{len(applied)} migração(ões) aplicada(s).')
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,67 @@
+import json
+import re
+
+from bs4 import BeautifulSoup
+
+
+NEXT_DATA_OPEN = re.compile(r'<script[^>]*\bid=["\']__NEXT_DATA__["\'][^>]*>')
+ENTITY_KEY = re.compile(r'"entity"\s*:\s*\{')
+AUDIO_PREVIEW_URL = re.compile(r'"audioPreview"\s*:\s*\{[^{}]*?"url"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def extract_preview_url_fast(html):
+
+    """
+    Extrai entity.audioPreview.url do __NEXT_DATA__ sem montar a árvore do HTML
+    nem decodificar o JSON inteiro. Retorna None se não encontrar.
+
+    A busca começa na chave "entity" e assume que o primeiro audioPreview depois dela é
+    o da própria entidade (nas páginas de embed os objetos aninhados antes dele, como
+    artists e coverArt, não têm audioPreview). scripts/bench_next_data.py confere essa
+    suposição contra o caminho do BeautifulSoup.
+    """
+
+    match = NEXT_DATA_OPEN.search(html)
+    if not match:
+        return None
+
+    end = html.find('</script>', match.end())
+    if end == -1:
+        return None
+
+    entity = ENTITY_KEY.search(html, match.end(), end)
+    if not entity:
+        return None
+
+    url = AUDIO_PREVIEW_URL.search(html, entity.end(), end)
+    if not url:
+        return None
+
+    # Decodifica os escapes do JSON (ex.: \u002F) sem carregar o blob inteiro
+    return json.loads(f'"{url.group(1)}"')
+
+
+def extract_preview_url_soup(html):
+
+    """
+    Caminho original: monta o DOM com BeautifulSoup e carrega o __NEXT_DATA__ completo.
+    """
+
+    soup = BeautifulSoup(html, "html.parser")
+
+    script_tag = soup.find("script", {"id": "__NEXT_DATA__"})
+
+    if not script_tag:
+        return None
+
+    data = json.loads(script_tag.string)
+    return data["props"]["pageProps"]["state"]["data"]["entity"]["audioPreview"]["url"]
+
+
+def extract_preview_url(html):
+
+    """
+    Tenta o extrator rápido e, se ele falhar, recorre ao BeautifulSoup.
+    """
+
+    return extract_preview_url_fast(html) or extract_preview_url_soup(html)
@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from threading import Lock
+
+from botocore.exceptions import ClientError
+
+
+class PreviewStore:
+
+    """
+    Armazenamento persistente dos previews MP3, endereçado pelo conteúdo.
+
+    Cada track_id aponta para o sha256 do arquivo no index.json, e os arquivos ficam em
+    objects/<sha[:2]>/<sha>.mp3. O store pode ficar em um diretório local ou em um
+    prefixo do S3 (uri no formato s3://bucket/prefixo); no S3 os arquivos são
+    materializados em local_dir antes de serem usados e apagados por close(). Quando o
+    tamanho total passa de max_bytes, os previews acessados há mais tempo são removidos
+    (LRU).
+
+    As tasks trocam apenas track_ids: cada worker resolve o arquivo com get(), então no
+    S3 o store funciona mesmo quando download e extração rodam em workers diferentes.
+    """
+
+    def __init__(self, uri, max_bytes, s3_client=None, local_dir='/tmp/spotify_previews') -> None:
+
+        self.max_bytes = max_bytes
+        self.local_dir = local_dir
+        self.lock = Lock()
+
+        # Um lock por sha256, para que conteúdos iguais sejam gravados uma única vez
+        self.sha_locks = {}
+        self.written = set()
+        # Cópias locais feitas por get() no modo S3, removidas em close()
+        self.materialized = set()
+
+        if uri.startswith('s3://'):
+            self.bucket, _, self.prefix = uri[len('s3://'):].partition('/')
+            self.prefix = self.prefix.strip('/')
+            self.s3_client = s3_client
+            self.root = None
+        else:
+            self.root = uri
+            self.s3_client = None
+
+        self.index, self.index_etag = self._load_index()
+        # track_ids removidos por este processo, para o merge não ressuscitá-los
+        self.evicted = set()
+
+    # ---------- Armazenamento ----------
+
+    def _object_key(self, sha):
+        return f'objects/{sha[:2]}/{sha}.mp3'
+
+    def _local_path(self, key):
+        base = self.root if self.root else self.local_dir
+        return os.path.join(base, key)
+
+    def _read(self, key):
+
+        if self.root:
+            with open(self._local_path(key), 'rb') as f:
+                return f.read()
+
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=f'{self.prefix}/{key}')
+        return response['Body'].read()
+
+    def _write_local(self, path, data):
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Escrita atômica, com um temporário único por chamada (threads e processos)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _write(self, key, data):
+
+        if self.root:
+            self._write_local(self._local_path(key), data)
+        else:
+            self.s3_client.put_object(Bucket=self.bucket, Key=f'{self.prefix}/{key}', Body=data)
+
+    def _delete(self, key):
+
+        path = self._local_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+        if not self.root:
+            self.s3_client.delete_object(Bucket=self.bucket, Key=f'{self.prefix}/{key}')
+
+    def _load_index(self):
+
+        """
+        Retorna (index, etag). Só a ausência do index.json significa store vazio; qualquer
+        outro erro é propagado, para não sobrescrever o index e deixar arquivos órfãos.
+        """
+
+        try:
+            if self.root:
+                with open(self._local_path('index.json'), 'rb') as f:
+                    return json.loads(f.read()), None
+
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=f'{self.prefix}/index.json')
+            return json.loads(response['Body'].read()), response['ETag']
+
+        except FileNotFoundError:
+            return {}, None
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return {}, None
+            raise
+
+    def _merge(self, stored):
+
+        """
+        Junta ao index em memória as entradas gravadas por outras execuções, ficando com o
+        acesso mais recente de cada track_id.
+        """
+
+        with self.lock:
+            for track_id, entry in stored.items():
+
+                if track_id in self.evicted:
+                    continue
+
+                current = self.index.get(track_id)
+                if current is None or entry['last_access'] > current['last_access']:
+                    self.index[track_id] = entry
+
+    def save_index(self, max_retries=5):
+
+        """
+        Grava o index mesclado com o que já está armazenado. No S3 a escrita é condicional
+        ao ETag lido (If-Match / If-None-Match), então execuções concorrentes não perdem
+        as entradas umas das outras.
+        """
+
+        for _ in range(max_retries):
+
+            stored, etag = self._load_index()
+
+            self._merge(stored)
+            self._evict(keep=None)
+
+            with self.lock:
+                data = json.dumps(self.index).encode()
+
+            if self.root:
+                self._write('index.json', data)
+                return
+
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+
+            try:
+                response = self.s3_client.put_object(
+                    Bucket=self.bucket, Key=f'{self.prefix}/index.json', Body=data, **condition
+                )
+                self.index_etag = response.get('ETag')
+                return
+
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+
+        raise RuntimeError(f'Não foi possível gravar o index do PreviewStore após {max_retries} tentativas')
+
+    # ---------- API ----------
+
+    def get(self, track_id):
+
+        """
+        Retorna o caminho local do preview da faixa, ou None se não estiver no store.
+        """
+
+        with self.lock:
+            entry = self.index.get(track_id)
+            if not entry:
+                return None
+            entry['last_access'] = time.time()
+
+        key = self._object_key(entry['sha256'])
+        path = self._local_path(key)
+
+        if not os.path.exists(path):
+            try:
+                data = self._read(key)
+            except Exception:
+                with self.lock:
+                    self.index.pop(track_id, None)
+                return None
+
+            self._write_local(path, data)
+
+            if not self.root:
+                with self.lock:
+                    self.materialized.add(path)
+
+        return path
+
+    def close(self):
+
+        """
+        Apaga as cópias locais materializadas por get() no modo S3.
+        """
+
+        with self.lock:
+            paths, self.materialized = self.materialized, set()
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __contains__(self, track_id):
+
+        with self.lock:
+            return track_id in self.index
+
+    def put(self, track_id, data):
+
+        """
+        Salva o preview da faixa e retorna o sha256 do conteúdo.
+        """
+
+        sha = hashlib.sha256(data).hexdigest()
+        key = self._object_key(sha)
+
+        with self.lock:
+            sha_lock = self.sha_locks.setdefault(sha, Lock())
+
+        # Threads com o mesmo conteúdo esperam a primeira gravação em vez de repeti-la
+        with sha_lock:
+
+            with self.lock:
+                already_stored = sha in self.written or any(e['sha256'] == sha for e in self.index.values())
+
+            if not already_stored:
+                self._write(key, data)
+
+                with self.lock:
+                    self.written.add(sha)
+
+        with self.lock:
+            self.index[track_id] = {'sha256': sha, 'size': len(data), 'last_access': time.time()}
+
+        self._evict(keep=track_id)
+
+        return sha
+
+    def _evict(self, keep):
+
+        removed = []
+
+        with self.lock:
+
+            blobs = {e['sha256']: e['size'] for e in self.index.values()}
+            total = sum(blobs.values())
+
+            for track_id, entry in sorted(self.index.items(), key=lambda kv: kv[1]['last_access']):
+
+                if total <= self.max_bytes:
+                    break
+
+                if track_id == keep:
+                    continue
+
+                del self.index[track_id]
+                self.evicted.add(track_id)
+
+                sha = entry['sha256']
+                if sha in blobs and not any(e['sha256'] == sha for e in self.index.values()):
+                    total -= blobs.pop(sha)
+                    self.written.discard(sha)
+                    removed.append(self._object_key(sha))
+
+        for key in removed:
+            self._delete(key)
@@ -0,0 +1,181 @@
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def retry_after(response):
+
+    """
+    Segundos pedidos pelo header Retry-After (em segundos ou como data HTTP), ou None.
+    """
+
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+
+    """
+    Rate limiter token bucket: libera até `rate` requisições por segundo, com
+    rajadas de no máximo `capacity`. Seguro para uso entre threads.
+    """
+
+    def __init__(self, rate, capacity) -> None:
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+
+        while True:
+
+            with self.lock:
+
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class ReccoBeatsClient:
+
+    """
+    Cliente do endpoint de análise de audio features do ReccoBeats.
+
+    Envia os previews a partir de um pool de workers limitado, respeitando o token
+    bucket, com timeout e novas tentativas para 429/5xx (usando o Retry-After quando
+    presente). A base_url é configurável para testes contra um servidor HTTP local.
+    """
+
+    def __init__(self, base_url='https://api.reccobeats.com', max_workers=4, rate=2.0, burst=4,
+                 timeout=(5, 60), max_retries=4) -> None:
+
+        self.endpoint = f'{base_url.rstrip("/")}/v1/analysis/audio-features'
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, burst)
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=max_workers))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=max_workers))
+
+        self.latencies = []
+        self.latencies_lock = Lock()
+
+    def close(self):
+
+        self.session.close()
+
+    def _retry_after(self, response):
+
+        return retry_after(response)
+
+    def extract(self, path):
+
+        """
+        Envia um preview para análise e retorna o dict de features, ou None em caso de falha.
+        """
+
+        for attempt in range(self.max_retries + 1):
+
+            self.bucket.acquire()
+            start = time.perf_counter()
+
+            try:
+                with open(path, 'rb') as f:
+                    response = self.session.post(
+                        self.endpoint,
+                        files={'audioFile': f},
+                        headers={'Accept': 'application/json'},
+                        timeout=self.timeout
+                    )
+            except OSError as e:
+                print(f'[ERROR] Falha ao abrir arquivo {path}: {e}')
+                return None
+            except requests.RequestException as e:
+                print(f'[WARN] Falha na requisição ao ReccoBeats para {path}: {e}')
+                response = None
+            finally:
+                with self.latencies_lock:
+                    self.latencies.append(time.perf_counter() - start)
+
+            if response is not None and response.status_code == 200:
+                return response.json()
+
+            if response is not None and response.status_code != 429 and response.status_code < 500:
+                print(f'[ERROR] Falha na extração de features de {path}. Status {response.status_code}')
+                return None
+
+            if attempt == self.max_retries:
+                break
+
+            wait = self._retry_after(response) if response is not None else None
+            if wait is None:
+                wait = random.uniform(0, min(30.0, 0.5 * 2 ** attempt))
+
+            time.sleep(wait)
+
+        print(f'[ERROR] Falha na extração de features de {path} após {self.max_retries + 1} tentativas')
+        return None
+
+    def extract_many(self, previews):
+
+        """
+        Recebe {track_id: caminho_do_preview} e retorna {track_id: features} apenas para
+        as faixas analisadas com sucesso. Cada track_id é enviado uma única vez.
+        """
+
+        track_ids = list(previews)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda track_id: self.extract(previews[track_id]), track_ids))
+
+        return {track_id: features for track_id, features in zip(track_ids, results) if features is not None}
+
+    def latency_summary(self):
+
+        """
+        Resumo (em segundos) das latências de todas as requisições feitas pelo cliente.
+        """
+
+        with self.latencies_lock:
+            latencies = sorted(self.latencies)
+
+        if not latencies:
+            return {'requests': 0}
+
+        return {
+            'requests': len(latencies),
+            'mean': sum(latencies) / len(latencies),
+            'p50': latencies[len(latencies) // 2],
+            'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'max': latencies[-1]
+        }
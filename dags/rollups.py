@@ -0,0 +1,107 @@
+import argparse
+import os
+
+#+-------------------------------------------------------------------------+
+#|        ROLLUPS DIÁRIOS DO PLAYBACK_HISTORY PARA O DASHBOARD             |
+#+-------------------------------------------------------------------------+
+
+# Dias (no fuso da sessão do banco) tocados pelos played_at recebidos
+TOUCHED_DAYS = """
+    WITH days AS (
+        SELECT DISTINCT ts::date AS day
+        FROM unnest(%(played_at)s::timestamptz[]) AS t(ts)
+    )
+"""
+
+ROLLUP_STATEMENTS = [
+    """
+        INSERT INTO daily_track (day, track_id, seconds, plays, skips)
+        SELECT d.day,
+               ph.track_id,
+               COALESCE(SUM(ph.playback_sec), 0),
+               COUNT(*),
+               COUNT(*) FILTER (WHERE ph.was_played = FALSE)
+        FROM days d
+            JOIN playback_history ph ON ph.played_at >= d.day AND ph.played_at < d.day + 1
+        GROUP BY d.day, ph.track_id
+        ON CONFLICT (day, track_id) DO UPDATE
+        SET seconds = EXCLUDED.seconds, plays = EXCLUDED.plays, skips = EXCLUDED.skips;
+    """,
+    """
+        INSERT INTO daily_artist (day, artist_id, seconds, plays)
+        SELECT d.day,
+               ta.artist_id,
+               COALESCE(SUM(ph.playback_sec), 0),
+               COUNT(*)
+        FROM days d
+            JOIN playback_history ph ON ph.played_at >= d.day AND ph.played_at < d.day + 1
+            JOIN track_artist ta ON ta.track_id = ph.track_id
+        GROUP BY d.day, ta.artist_id
+        ON CONFLICT (day, artist_id) DO UPDATE
+        SET seconds = EXCLUDED.seconds, plays = EXCLUDED.plays;
+    """,
+]
+
+
+def refresh_rollups(cursor, played_at):
+
+    """
+    Recalcula daily_track e daily_artist apenas para os dias que
+    contêm os played_at informados. Não faz commit.
+    """
+
+    if not played_at:
+        return
+
+    for statement in ROLLUP_STATEMENTS:
+        cursor.execute(TOUCHED_DAYS + statement, {'played_at': list(played_at)})
+
+
+def rebuild_rollups(conn):
+
+    """
+    Regenera todos os rollups a partir do histórico completo do playback_history e
+    registra uma linha em pipeline_load (requer a migração 4).
+    """
+
+    cursor = conn.cursor()
+
+    cursor.execute("TRUNCATE daily_track, daily_artist")
+
+    # Um timestamp por dia é suficiente para marcar o dia como tocado
+    cursor.execute("SELECT MIN(played_at) FROM playback_history GROUP BY played_at::date")
+    played_at = [row[0] for row in cursor.fetchall()]
+
+    refresh_rollups(cursor, played_at)
+
+    # Registra o rebuild como uma carga, para invalidar o cache de consultas do dashboard
+    cursor.execute(
+        "INSERT INTO pipeline_load (rows, max_played_at) SELECT 0, MAX(played_at) FROM playback_history"
+    )
+
+    conn.commit()
+    cursor.close()
+
+    print(f'[INFO] Rollups regenerados para {len(played_at)} dias.')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Regenera os rollups diários a partir do playback_history')
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'),
+                        help='string de conexão do Postgres (padrão: $DATABASE_URL)')
+    args = parser.parse_args()
+
+    import psycopg2
+
+    conn = psycopg2.connect(args.dsn)
+
+    try:
+        rebuild_rollups(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,147 @@
+import io
+import pendulum
+
+from datetime import datetime, timedelta
+
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+from airflow.providers.amazon.aws.hooks.s3 import S3Hook
+
+from spotify_storage import read_manifest, is_snapshot, decode_snapshot
+
+#+-------------------------------------------------------------------------+
+#|           COMPACTAÇÃO DIÁRIA DOS SNAPSHOTS EM PARQUET                   |
+#+-------------------------------------------------------------------------+
+
+
+def build_compacted_table( plays ):
+
+    """
+    Monta a tabela Arrow tipada com uma linha por reprodução.
+    """
+
+    import pyarrow as pa
+
+    schema = pa.schema([
+        ('played_at', pa.timestamp('ms', tz='UTC')),
+        ('track_id', pa.string()),
+        ('track_name', pa.string()),
+        ('duration_ms', pa.int32()),
+        ('popularity', pa.int16()),
+        ('explicit', pa.bool_()),
+        ('album_id', pa.string()),
+        ('album_name', pa.string()),
+        ('album_release_date', pa.string()),
+        ('artist_ids', pa.list_(pa.string())),
+        ('artist_names', pa.list_(pa.string())),
+        ('context_type', pa.string()),
+        ('context_uri', pa.string())
+    ])
+
+    rows = []
+
+    for play in plays:
+
+        track = play.get('track') or {}
+        album = track.get('album') or {}
+        artists = track.get('artists') or []
+        context = play.get('context') or {}
+
+        rows.append({
+            'played_at': datetime.fromisoformat( play['played_at'].replace('Z', '+00:00') ),
+            'track_id': track.get('id'),
+            'track_name': track.get('name'),
+            'duration_ms': track.get('duration_ms'),
+            'popularity': track.get('popularity'),
+            'explicit': track.get('explicit'),
+            'album_id': album.get('id'),
+            'album_name': album.get('name'),
+            'album_release_date': album.get('release_date'),
+            'artist_ids': [ artist.get('id') for artist in artists ],
+            'artist_names': [ artist.get('name') for artist in artists ],
+            'context_type': context.get('type'),
+            'context_uri': context.get('uri')
+        })
+
+    return pa.Table.from_pylist( rows, schema=schema )
+
+def played_on( play, timezone ):
+
+    """
+    Data local (no fuso das pastas arquivos/YYYYMMDD/) em que a reprodução aconteceu.
+    """
+
+    return pendulum.parse( play['played_at'] ).in_timezone( timezone ).date()
+
+def compact_daily_snapshots( **kwargs ):
+
+    """
+    Junta os snapshots tracks_history_* que podem conter reproduções do dia, remove as
+    repetidas entre snapshots (pelo played_at) e grava um único Parquet em
+    compacted/date=YYYY-MM-DD/tracks_history.parquet.
+
+    A pasta arquivos/YYYYMMDD/ é o dia em que o snapshot foi gravado, não o da reprodução:
+    o snapshot da meia-noite do dia seguinte ainda traz reproduções do dia. Por isso são
+    lidas as pastas do dia e do dia seguinte, e cada reprodução entra na partição da data
+    do seu played_at (America/Sao_Paulo).
+    """
+
+    import pyarrow.parquet as pq
+
+    hook = S3Hook( aws_conn_id='aws_conn' )
+    s3_client = hook.get_conn()
+    bucket_name = 'personal-spotify-wrapped'
+
+    timezone = 'America/Sao_Paulo'
+    day = kwargs['data_interval_start'].in_timezone( timezone )
+
+    entries = [
+        entry
+        for folder_day in ( day, day.add( days=1 ) )
+        for entry in read_manifest( s3_client, bucket_name, folder_day.strftime( '%Y%m%d' ) )
+        if is_snapshot( entry['key'] )
+    ]
+
+    if not entries:
+        print( f"[INFO] Nenhum snapshot em arquivos/{day.strftime('%Y%m%d')}/ ou no dia seguinte para compactar." )
+        return
+
+    plays = {}
+
+    for entry in entries:
+
+        body = s3_client.get_object( Bucket=bucket_name, Key=entry['key'] )['Body'].read()
+
+        for play in decode_snapshot( body, entry['key'] ):
+            if played_on( play, timezone ) == day.date():
+                plays.setdefault( play['played_at'], play )
+
+    table = build_compacted_table( sorted( plays.values(), key=lambda play: play['played_at'] ) )
+
+    buffer = io.BytesIO()
+    pq.write_table( table, buffer, compression='zstd' )
+
+    key = f"compacted/date={day.strftime('%Y-%m-%d')}/tracks_history.parquet"
+
+    s3_client.put_object( Bucket=bucket_name, Key=key, Body=buffer.getvalue() )
+
+    print( f'[INFO] {len(entries)} snapshots lidos; {table.num_rows} reproduções únicas do dia gravadas em {key}.' )
+
+dag = DAG(
+        dag_id = "spotify_compaction",
+        # Intervalos diários no fuso das pastas arquivos/YYYYMMDD/. O dia D roda às 06:00
+        # de D+1, depois dos snapshots da madrugada que ainda trazem reproduções de D.
+        start_date=pendulum.datetime(2025, 1, 5, tz='America/Sao_Paulo'),
+        schedule_interval='0 6 * * *',
+        catchup=False,
+        default_args={
+            "retries": 2,
+            "retry_delay": timedelta(minutes=45)
+        }
+    )
+
+compact_snapshots = PythonOperator(
+    task_id='compact_daily_snapshots',
+    python_callable=compact_daily_snapshots,
+    dag=dag
+)
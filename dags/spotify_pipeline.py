@@ -1,12 +1,22 @@
 import json
+import random
 import requests
 import boto3
 
-from bs4 import BeautifulSoup
+from time import sleep
+from collections import OrderedDict
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
-from dateutil.parser import parse
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime, timedelta, timezone
 from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from psycopg2.extras import execute_values
 from airflow import DAG
 from airflow.operators.python import PythonOperator, BranchPythonOperator
 from airflow.providers.amazon.aws.hooks.s3 import S3Hook
@@ -15,6 +25,41 @@ from airflow.providers.postgres.hooks.postgres import PostgresHook
 from airflow.exceptions import AirflowFailException
 from airflow.models import Variable
 
+from preview_store import PreviewStore
+from embed_parser import extract_preview_url
+from reccobeats_client import ReccoBeatsClient, retry_after
+from artifacts import write_artifact, read_artifact, delete_artifact
+from spotify_token import SpotifyTokenManager
+from db_migrations import apply_migrations
+from rollups import refresh_rollups
+from spotify_storage import read_manifest, append_to_manifest, is_snapshot, encode_snapshot, decode_snapshot
+
+# Token do Spotify compartilhado pelas funções do processo (ver get_token_manager)
+TOKEN_MANAGER = None
+
+# LRU em memória de ((name, image_url, popularity, followers), buscado_em) por artist_id
+ARTIST_CACHE = OrderedDict()
+ARTIST_CACHE_SIZE = 5000
+
+# Campos do item do DynamoDB usados pelas etapas seguintes da DAG
+TRACK_PROJECTION = [
+    'played_at',
+    'track.id', 'track.name', 'track.duration_ms', 'track.uri', 'track.explicit',
+    'track.popularity', 'track.artists',
+    'track.album.id', 'track.album.name', 'track.album.release_date',
+    'track.album.release_date_precision', 'track.album.total_tracks',
+    'track.album.album_type', 'track.album.images'
+]
+
+# Dias mantidos no watermark dos manifests (Variable s3_manifest_watermark)
+MANIFEST_WATERMARK_DAYS = 7
+
+# Download concorrente dos previews
+PREVIEW_WORKERS = 16
+PER_HOST_CONCURRENCY = 8
+HOST_SEMAPHORES = {}
+HOST_SEMAPHORES_LOCK = Lock()
+
 #+-------------------------------------------------------------------------+
 #|                   FUNÇÕES DO PYTHON_SCRAPER.PY                          |
 #+-------------------------------------------------------------------------+
@@ -31,16 +76,15 @@ def decide_path_by_date(**context):
     execution_date = context['execution_date'].astimezone()
     folder_date = execution_date.strftime('%Y%m%d')
     file_date = execution_date.strftime('%Y%m%d_%H%M%S')
-    prefix = f'arquivos/{folder_date}/'
 
     hook = S3Hook( aws_conn_id='aws_conn' )
     bucket_name = 'personal-spotify-wrapped'
 
-    keys = hook.list_keys( bucket_name=bucket_name, prefix=prefix )
+    keys = [ entry['key'] for entry in read_manifest( hook.get_conn(), bucket_name, folder_date ) ]
 
     if keys:
         for key in keys:
-            if key.endswith('.json') and file_date in key:
+            if is_snapshot( key ) and file_date in key:
                 print(f'[INFO] Arquivo para a execution_date {execution_date} encontrado: {key}.')
                 return ['check_s3_folder']
 
@@ -50,48 +94,58 @@ def decide_path_by_date(**context):
 def refresh_spotify_token():
 
     """
-    Atualiza o token de acesso da API do Spotify usando o refresh_token
+    Garante um access_token válido para a execução, renovando-o com o refresh_token
+    apenas quando ele está perto de expirar.
 
     """
 
-    url = 'https://accounts.spotify.com/api/token'
+    try:
+        get_token_manager().get_token()
 
-    access_token = Variable.get( 'access_token' )
-    refresh_token = Variable.get( 'refresh_token' )
-    client_id = Variable.get( 'client_id' )
-    date_token = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-    client_secret = Variable.get( 'client_secret' )
+    except RuntimeError as e:
 
+        raise AirflowFailException( f'Falha ao obter o access_token: {e}' )
 
-    data = {
-        'grant_type': 'refresh_token',
-        'refresh_token': refresh_token,
-        'client_id': client_id,
-        'client_secret': client_secret
-    }
+def get_token_manager():
 
-    print(data)
+    """
+    Retorna o SpotifyTokenManager do processo, persistido nas Variables do Airflow.
+    """
 
-    response = requests.post( url, data=data )
+    global TOKEN_MANAGER
 
-    if response.status_code == 200:
+    if TOKEN_MANAGER is None:
 
-        access_token = response.json().get( 'access_token' )
-        refresh_token = response.json().get( 'refresh_token' )
-        Variable.set( 'access_token', access_token )
-        Variable.set( 'refresh_token', refresh_token )
+        def _load():
+            return {
+                'access_token': Variable.get( 'access_token', default_var=None ),
+                'refresh_token': Variable.get( 'refresh_token' ),
+                'expires_at': Variable.get( 'access_token_expires_at', default_var=0 )
+            }
 
-        print( f'Novo access_token obtido. {date_token}')
+        def _save( state ):
+            Variable.set( 'access_token', state['access_token'] )
+            Variable.set( 'refresh_token', state['refresh_token'] )
+            Variable.set( 'access_token_expires_at', state['expires_at'] )
 
-    else:
+        TOKEN_MANAGER = SpotifyTokenManager(
+            _load, _save,
+            client_id=Variable.get( 'client_id' ),
+            client_secret=Variable.get( 'client_secret' )
+        )
 
-        raise AirflowFailException( 'Falha ao obter o access_token' )
+    return TOKEN_MANAGER
 
 
 def get_spotify_history( **kwargs ):
 
     """
-    Coleta as 50 últimas músicas reproduzidas recentemente na API do Spotify.
+    Coleta as músicas reproduzidas recentemente na API do Spotify.
+
+    No modo incremental (padrão), busca apenas as reproduções posteriores ao watermark
+    (Variable history_watermark_ms) com o cursor `after`, paginando até alcançar o
+    presente; se não houver nada novo, nenhum arquivo é gravado. No modo 'before', ou
+    sem watermark, coleta as 50 últimas antes da next_execution_date.
 
     Os dados coletados são salvos em um arquivo JSON no S3, com base na execution_date.
     """
@@ -102,37 +156,89 @@ def get_spotify_history( **kwargs ):
     date_now = kwargs['next_execution_date'].in_timezone( 'America/Sao_Paulo' )
     before = int(round(date_now.timestamp() * 1000))
 
-    access_token = Variable.get( 'access_token' )
+    access_token = get_token_manager().get_token()
 
     print( f'Execution Date: {date_now}' )
 
-    params = {
-        'limit': limit,
-        'before': before
-    }
-
     headers = {
         'Authorization': f'Bearer {access_token}'
     }
 
-    response = requests.get( url, params=params, headers=headers )
+    mode = Variable.get( 'history_fetch_mode', default_var='incremental' )
+    watermark = Variable.get( 'history_watermark_ms', default_var=None )
 
-    if response.status_code == 200:
+    if mode == 'incremental' and watermark:
+
+        data = fetch_history_after( url, headers, int(watermark), limit )
+
+        if not data:
+            print( f'[INFO] Nenhuma reprodução nova desde o watermark {watermark}. Nada a gravar no S3.' )
+            return
+
+    else:
+
+        params = {
+            'limit': limit,
+            'before': before
+        }
+
+        response = requests.get( url, params=params, headers=headers )
+
+        if response.status_code != 200:
+            raise AirflowFailException( 'Falha ao tentar obter o histórico de músicas' )
 
         data = response.json()['items']
 
-        date_now = kwargs['next_execution_date'].in_timezone( 'America/Sao_Paulo' )
+    save_json_to_s3( data, date_now)
 
+    if data:
 
-        save_json_to_s3( data, date_now)
-    else:
+        newest = max( played_at_ms( item['played_at'] ) for item in data )
+
+        if not watermark or newest > int(watermark):
+            Variable.set( 'history_watermark_ms', newest )
+
+def fetch_history_after( url, headers, after, limit ):
+
+    """
+    Pagina para frente com o cursor `after` e retorna as reproduções posteriores a ele,
+    sem repetições.
+    """
+
+    items = {}
+
+    while True:
 
-        raise AirflowFailException( 'Falha ao tentar obter o histórico de músicas' )
+        response = requests.get( url, params={'limit': limit, 'after': after}, headers=headers )
+
+        if response.status_code != 200:
+            raise AirflowFailException( 'Falha ao tentar obter o histórico de músicas' )
+
+        page = response.json()
+        page_items = page.get('items', [])
+
+        for item in page_items:
+            if played_at_ms( item['played_at'] ) > after:
+                items[item['played_at']] = item
+
+        next_after = ( page.get('cursors') or {} ).get('after')
+
+        if len(page_items) < limit or not next_after or int(next_after) <= after:
+            break
+
+        after = int(next_after)
+
+    return sorted( items.values(), key=lambda item: item['played_at'], reverse=True )
+
+def played_at_ms( played_at ):
+
+    return int( datetime.fromisoformat( played_at.replace('Z', '+00:00') ).timestamp() * 1000 )
 
 def save_json_to_s3( data, date ):
 
     """
-    Salva os dados de faixas do Spotify em formato JSON no bucket S3.
+    Salva os dados de faixas do Spotify no bucket S3, no formato definido pela Variable
+    raw_snapshot_format, e registra o arquivo no manifest do dia.
 
     """
     
@@ -143,23 +249,29 @@ def save_json_to_s3( data, date ):
         region_name=Variable.get( 'aws_region' )
     )
 
+    # Formatos: json (original), json.gz, ndjson.gz, json.zst, ndjson.zst
+    raw_format = Variable.get( 'raw_snapshot_format', default_var='json' )
+    projection = Variable.get( 'raw_snapshot_projection', default_var='false' ).lower() == 'true'
+
+    json_data, extension, content_type = encode_snapshot( data, raw_format, projection )
+
     date = date.strftime( '%Y%m%d_%H%M%S' )
     bucket_name = Variable.get( 's3_bucket_name')
-    filename = f'tracks_history_{date}.json'
+    filename = f'tracks_history_{date}{extension}'
     date_folder = date.split('_')[0]
     file_path = f'arquivos/{date_folder}/{filename}'
 
     print( f' Data Pasta: {date_folder}' )
 
-    json_data = json.dumps( data, indent=4 )
-
-    s3_client.put_object(
+    response = s3_client.put_object(
         Bucket=bucket_name,
         Key=file_path,
         Body=json_data,
-        ContentType='application/json'
+        ContentType=content_type
     )
 
+    append_to_manifest( s3_client, bucket_name, date_folder, file_path, len(json_data), response['ETag'] )
+
     print( f'Arquivo salvo no S3: {bucket_name}/{file_path}' )
 
 def create_s3_folder_if_not_exists( **kwargs ):
@@ -196,35 +308,43 @@ def create_s3_folder_if_not_exists( **kwargs ):
 
 def check_s3_folder ( **kwargs ):
 
+    """
+    Descobre os snapshots do dia pelo manifest e envia para o XCom apenas os que
+    ainda não foram processados segundo o watermark (Variable s3_manifest_watermark).
+    """
+
     hook = S3Hook( aws_conn_id='aws_conn' )
     bucket_name = 'personal-spotify-wrapped'
 
     date_now = kwargs['next_execution_date'].in_timezone( 'America/Sao_Paulo' )
     date = date_now.strftime('%Y%m%d')
 
-    prefix = f'arquivos/{date}/'
+    print( f'        A PASTA QUE ESTOU PROCURANDO É A arquivos/{date}/' )
 
-    print( f'        A PASTA QUE ESTOU PROCURANDO É A {prefix}' )
+    entries = read_manifest( hook.get_conn(), bucket_name, date )
 
-    if hook.check_for_prefix(bucket_name=bucket_name, prefix=prefix, delimiter='/'):
-        
-        files_bucket = hook.list_keys(bucket_name=bucket_name, prefix=prefix, max_items=30)
+    if not entries:
+        # Pode acontecer no modo incremental, quando não houve reprodução nova no dia
+        print(f'Não foram encontrados arquivos em arquivos/{date}/ no AWS S3')
+        entries = []
 
-        files = [file for file in files_bucket if file.endswith('.json')]
+    watermark = json.loads( Variable.get( 's3_manifest_watermark', default_var='{}' ) )
+    processed = watermark.get( date, 0 )
 
-        kwargs['ti'].xcom_push(key="json_files", value=files)
+    files = [ entry['key'] for entry in entries[processed:] if is_snapshot( entry['key'] ) ]
 
-        print(files)
+    kwargs['ti'].xcom_push(key="json_files", value=files)
+    kwargs['ti'].xcom_push(key="manifest_position", value={'date': date, 'position': len(entries)})
 
-    else:
-        print(f'Não foi encontrada a pasta {prefix} no AWS S3')
+    print(files)
 
 def open_json_files(**context):
 
     """
     Lê os arquivos JSON salvos no S3 e insere os dados de reprodução no DynamoDB.
 
-    Verifica se já existe o item com base no campo 'played_at' antes de inserir.
+    As chaves (date_played, hour_played) de todos os arquivos são verificadas em lote
+    com BatchGetItem e apenas os itens novos são gravados com BatchWriteItem.
     """
 
     aws_hook = AwsBaseHook(aws_conn_id="aws_conn", client_type="dynamodb")
@@ -242,19 +362,26 @@ def open_json_files(**context):
         task_ids='check_s3_folder', key='json_files'
     )
 
-    if not files:
+    if files is None:
         raise AirflowFailException("Nenhum arquivo JSON foi retornado por check_s3_folder")
-    
+
+    if not files:
+        print( '[INFO] Nenhum arquivo novo desde a última execução.' )
+
+    # Os snapshots se sobrepõem, então a mesma reprodução aparece em vários arquivos
+    items = {}
+
     for file in files:
 
         print(file)
 
-        file_content = hook.read_key(
+        file_content = hook.get_key(
             key=file,
-            bucket_name='personal-spotify-wrapped'
-        )
+            bucket_name=bucket_name
+        ).get()['Body'].read()
 
-        json_data = json.loads(file_content)
+        # Lê tanto os JSON indentados antigos quanto os formatos comprimidos
+        json_data = decode_snapshot( file_content, file )
 
         for track in json_data:
 
@@ -264,38 +391,161 @@ def open_json_files(**context):
             date_played = dt.strftime('%Y-%m-%d') # Partition Key
             hour_played = dt.strftime('%H:%M:%S') # Sort Key
 
-            musica = track['track']['name']
-            artista = track['track']['artists'][0]['name']
+            items[(date_played, hour_played)] = {
+                'date_played': date_played,
+                'hour_played': hour_played,
+                'played_at': played_at,
+                'track': track['track'],
+                'context': track.get('context')
+            }
+
+    # 'batch': BatchGetItem + BatchWriteItem | 'conditional': put_item condicional em paralelo
+    write_mode = Variable.get( 'dynamodb_write_mode', default_var='batch' )
 
-            existing_item = dynamodb_client.get_item(
-                TableName = table_name,
-                Key={
-                    'date_played': {'S': date_played},
-                    'hour_played': {'S': hour_played}
-                }
+    if write_mode == 'conditional':
+
+        dynamo_items = [ {k: serializer.serialize(v) for k, v in item.items()} for item in items.values() ]
+
+        inserted, skipped = put_items_conditionally( dynamodb_client, table_name, dynamo_items )
+
+        print( f'[INFO] {inserted} reproduções inseridas, {skipped} já existiam no DynamoDB.' )
+
+    else:
+
+        existing_keys = batch_get_existing_keys( dynamodb_client, table_name, list(items) )
+
+        new_items = [ item for key, item in items.items() if key not in existing_keys ]
+
+        for item in new_items:
+            print(f"Adicionado: {item['track']['name']} - {item['track']['artists'][0]['name']} em {item['played_at']}")
+
+        dynamo_items = [ {k: serializer.serialize(v) for k, v in item.items()} for item in new_items ]
+
+        batch_write_items( dynamodb_client, table_name, dynamo_items )
+
+        print( f'[INFO] {len(new_items)} reproduções inseridas, {len(existing_keys)} já existiam no DynamoDB.' )
+
+    # Só avança o watermark depois que os arquivos foram gravados no DynamoDB
+    position = context["task_instance"].xcom_pull( task_ids='check_s3_folder', key='manifest_position' )
+
+    watermark = json.loads( Variable.get( 's3_manifest_watermark', default_var='{}' ) )
+    watermark[position['date']] = max( watermark.get( position['date'], 0 ), position['position'] )
+
+    # Só os dias que ainda podem ser reprocessados (reexecuções recentes) ficam no watermark
+    cutoff = ( datetime.strptime( position['date'], '%Y%m%d' ) - timedelta( days=MANIFEST_WATERMARK_DAYS ) ).strftime( '%Y%m%d' )
+    watermark = { date: processed for date, processed in watermark.items() if date >= cutoff }
+
+    Variable.set( 's3_manifest_watermark', json.dumps( watermark ) )
+
+def chunks( values, size ):
+
+    for i in range( 0, len(values), size ):
+        yield values[i:i + size]
+
+def batch_get_existing_keys( dynamodb_client, table_name, keys, max_retries=8 ):
+
+    """
+    Retorna o conjunto de chaves (date_played, hour_played) que já existem na tabela.
+
+    As chaves são consultadas em blocos de 100 (limite do BatchGetItem) e as
+    UnprocessedKeys são reenviadas com backoff exponencial.
+    """
+
+    existing = set()
+
+    for chunk in chunks( keys, 100 ):
+
+        request = {
+            table_name: {
+                'Keys': [
+                    {'date_played': {'S': date_played}, 'hour_played': {'S': hour_played}}
+                    for date_played, hour_played in chunk
+                ],
+                'ProjectionExpression': 'date_played, hour_played'
+            }
+        }
+
+        for attempt in range( max_retries + 1 ):
+
+            response = dynamodb_client.batch_get_item( RequestItems=request )
+
+            for item in response['Responses'].get( table_name, [] ):
+                existing.add( (item['date_played']['S'], item['hour_played']['S']) )
+
+            request = response.get( 'UnprocessedKeys' ) or {}
+
+            if not request:
+                break
+
+            if attempt == max_retries:
+                raise AirflowFailException( 'UnprocessedKeys restantes após esgotar as tentativas no BatchGetItem' )
+
+            backoff( attempt )
+
+    return existing
+
+def batch_write_items( dynamodb_client, table_name, dynamo_items, max_retries=8 ):
+
+    """
+    Grava os itens já serializados em blocos de 25 (limite do BatchWriteItem),
+    reenviando os UnprocessedItems com backoff exponencial.
+    """
+
+    for chunk in chunks( dynamo_items, 25 ):
+
+        request = { table_name: [ {'PutRequest': {'Item': item}} for item in chunk ] }
+
+        for attempt in range( max_retries + 1 ):
+
+            response = dynamodb_client.batch_write_item( RequestItems=request )
+
+            request = response.get( 'UnprocessedItems' ) or {}
+
+            if not request:
+                break
+
+            if attempt == max_retries:
+                raise AirflowFailException( 'UnprocessedItems restantes após esgotar as tentativas no BatchWriteItem' )
+
+            backoff( attempt )
+
+def put_items_conditionally( dynamodb_client, table_name, dynamo_items, max_workers=8 ):
+
+    """
+    Grava cada item com um único put_item condicional, em paralelo.
+
+    A condição attribute_not_exists(date_played) torna a escrita idempotente mesmo
+    com execuções da DAG sobrepostas: ConditionalCheckFailedException significa que
+    a reprodução já estava no DynamoDB. Retorna (inseridos, já existentes).
+    """
+
+    conditional_failed = dynamodb_client.exceptions.ConditionalCheckFailedException
+
+    def _put( item ):
+        try:
+            dynamodb_client.put_item(
+                TableName=table_name,
+                Item=item,
+                ConditionExpression='attribute_not_exists(date_played)'
             )
+        except conditional_failed:
+            return False
+        return True
 
-            if "Item" not in existing_item:
+    with ThreadPoolExecutor( max_workers=max_workers ) as executor:
+        results = list( executor.map( _put, dynamo_items ) )
 
-                dynamo_item_dict = {
-                    'date_played': date_played,
-                    'hour_played': hour_played,
-                    'played_at': played_at,
-                    'track': track['track'],
-                    'context': track.get('context')
-                }
+    inserted = sum( results )
 
-                dynamo_item = {k: serializer.serialize(v) for k, v in dynamo_item_dict.items()}
+    return inserted, len(results) - inserted
 
-                dynamodb_client.put_item(
-                    TableName = table_name,
-                    Item=dynamo_item
-                )
+def backoff( attempt, base=0.1, cap=5.0 ):
 
-                print(f'Adicionado: {musica} - {artista} em {played_at}')
+    """
+    Espera com backoff exponencial e jitter completo antes de uma nova tentativa.
+    """
 
-            else:
-                print(f'Já existe o registro da música {musica} executada em {played_at} no banco de dados')
+    sleep( random.uniform( 0, min( cap, base * 2 ** attempt ) ) )
 
 
 #+-------------------------------------------------------------------------+
@@ -304,89 +554,399 @@ def open_json_files(**context):
 
 def extract_tracks_from_dynamodb( **kwargs ):
 
+    """
+    Lê as reproduções do DynamoDB, paginando pelo LastEvaluatedKey e trazendo apenas
+    os campos usados pela DAG.
+
+    Por padrão lê o dia da execution_date. Para backfills, a DAG pode ser disparada com
+    conf {"start_date": "YYYY-MM-DD", "end_date": "YYYY-MM-DD"}, e os dias do
+    intervalo são consultados em paralelo.
+    """
+
     aws_hook = AwsBaseHook( aws_conn_id='aws_conn', client_type='dynamodb' )
     dynamo_client = aws_hook.get_client_type()
     table_name = 'spotify_tracks_history'
 
-    execution_date = kwargs['execution_date'].strftime( '%Y-%m-%d' )
+    dag_run = kwargs.get('dag_run')
+    conf = ( dag_run.conf if dag_run else None ) or {}
+
+    if conf.get('start_date'):
+
+        try:
+            start = datetime.strptime( conf['start_date'], '%Y-%m-%d' )
+            end = datetime.strptime( conf.get('end_date', conf['start_date']), '%Y-%m-%d' )
+        except ValueError as e:
+            raise AirflowFailException( f'Datas inválidas no conf da DAG: {e}' )
+
+        if end < start:
+            raise AirflowFailException( f"end_date ({conf['end_date']}) é anterior a start_date ({conf['start_date']})" )
+
+        days = [ ( start + timedelta(days=i) ).strftime( '%Y-%m-%d' ) for i in range( (end - start).days + 1 ) ]
+
+    else:
+        days = [ kwargs['execution_date'].strftime( '%Y-%m-%d' ) ]
+
+    def _query_day( date_played ):
+        return [ item for page in query_played_day( dynamo_client, table_name, date_played ) for item in page ]
+
+    with ThreadPoolExecutor( max_workers=min( len(days), 8 ) ) as executor:
+        raw_items = [ item for day_items in executor.map( _query_day, days ) for item in day_items ]
+
+    print( f'[INFO] {len(raw_items)} reproduções lidas do DynamoDB para {len(days)} dia(s).' )
+
+    items = clean_dynamodb_items( raw_items )
+
+    # A primeira reprodução do dia seguinte fecha a última reprodução do intervalo
+    next_day = ( datetime.strptime( days[-1], '%Y-%m-%d' ) + timedelta(days=1) ).strftime( '%Y-%m-%d' )
+    boundary = first_played_at( dynamo_client, table_name, next_day )
+
+    watermark = json.loads( Variable.get( 'playback_watermark', default_var='null' ) )
+
+    items, correction, new_watermark = apply_watermark( items, boundary, watermark )
+
+    kwargs['ti'].xcom_push( key='playback_correction', value=correction )
+    kwargs['ti'].xcom_push( key='playback_watermark', value=new_watermark )
+
+    push_artifact( kwargs, 'tracks', items )
+
+def compute_playback( items, next_played_at=None, played_at=None ):
+
+    """
+    Ordena as reproduções e calcula was_played e playback_sec de forma vetorizada.
+
+    Os timestamps são convertidos uma única vez e o intervalo até a próxima reprodução
+    vem de um diff sobre a coluna inteira, inclusive entre dias diferentes. A
+    reprodução seguinte ao lote (next_played_at), quando conhecida, fecha o último item;
+    sem ela o último item é considerado tocado por completo.
+
+    Retorna (itens ordenados, played_at já convertidos na mesma ordem). O segundo
+    argumento, quando informado, evita converter os timestamps de novo.
+    """
+
+    if not items:
+        return items, []
+
+    if played_at is None:
+        played_at = pd.to_datetime( [ item['played_at'] for item in items ], format='ISO8601', utc=True )
+
+    frame = pd.DataFrame({
+        'played_at': played_at,
+        'duration_sec': [ int( item['track'].get('duration_ms', 0) ) // 1000 for item in items ]
+    }).sort_values( 'played_at', kind='stable' )
+
+    next_played = frame['played_at'].shift( -1 )
+
+    if next_played_at:
+        next_played.iloc[-1] = pd.to_datetime( next_played_at, format='ISO8601', utc=True )
+
+    gap = ( next_played - frame['played_at'] ).dt.total_seconds()
+    duration = frame['duration_sec'].astype( float )
+
+    was_played = ( gap >= duration * 0.9 ) | gap.isna() # margem de 90%
+    playback_sec = np.fmin( gap, duration )
+
+    ordered = []
+
+    for idx, played, seconds in zip( frame.index, was_played, playback_sec ):
+
+        item = items[idx]
+        item['was_played'] = bool( played )
+        item['playback_sec'] = float( seconds )
+        ordered.append( item )
+
+    return ordered, list( frame['played_at'] )
+
+def apply_watermark( items, next_played_at, watermark ):
+
+    """
+    Calcula o playback do lote levando em conta a última reprodução da execução anterior.
+
+    O watermark ({played_at, duration_ms}) é a última reprodução já gravada no Postgres,
+    que foi salva com was_played/playback_sec provisórios porque a reprodução seguinte
+    ainda não existia. Se ela for anterior ao lote, entra no cálculo como item auxiliar;
+    quando a próxima reprodução é conhecida, seus valores finais voltam como correção.
+
+    Retorna (itens, correção ou None, novo watermark ou None).
+    """
+
+    if not items:
+        return items, None, None
+
+    # Cada timestamp é convertido uma única vez; compute_playback devolve a coluna ordenada
+    played_at = [ item['played_at'] for item in items ]
+
+    auxiliary = None
+
+    if watermark:
+        played_at.append( watermark['played_at'] )
+
+    parsed = pd.to_datetime( played_at, format='ISO8601', utc=True )
+
+    watermark_at = parsed[-1] if watermark else None
+
+    if watermark and watermark_at < parsed[:len(items)].min():
+        auxiliary = {
+            'played_at': watermark['played_at'],
+            'track': {'duration_ms': watermark['duration_ms']}
+        }
+
+    if auxiliary:
+        ordered, ordered_at = compute_playback( items + [auxiliary], next_played_at, parsed )
+    else:
+        ordered, ordered_at = compute_playback( items, next_played_at, parsed[:len(items)] )
+
+    correction = None
+
+    for idx, ( item, item_at ) in enumerate( zip( ordered, ordered_at ) ):
+
+        has_next = idx < len(ordered) - 1 or next_played_at is not None
+
+        if watermark and has_next and item_at == watermark_at:
+            correction = {
+                'played_at': watermark['played_at'],
+                'playback_sec': item['playback_sec'],
+                'was_played': item['was_played']
+            }
+            break
+
+    kept = [ ( item, item_at ) for item, item_at in zip( ordered, ordered_at ) if item is not auxiliary ]
+    ordered = [ item for item, _ in kept ]
+
+    tail, tail_at = kept[-1]
+    new_watermark = None
+
+    if not watermark or tail_at > watermark_at:
+        new_watermark = {
+            'played_at': tail['played_at'],
+            'duration_ms': int( tail['track'].get('duration_ms', 0) )
+        }
+
+    return ordered, correction, new_watermark
+
+def first_played_at( dynamo_client, table_name, date_played ):
+
+    """
+    Retorna o played_at da primeira reprodução do dia, ou None se não houver.
+    """
 
     response = dynamo_client.query(
         TableName=table_name,
         KeyConditionExpression='date_played = :date',
         ExpressionAttributeValues={
-            ":date": {'S': execution_date}
-        }
+            ":date": {'S': date_played}
+        },
+        ProjectionExpression='played_at',
+        ScanIndexForward=True,
+        Limit=1
     )
 
     items = clean_dynamodb_items( response['Items'] )
 
-    items.sort( key=lambda x: parse(x['played_at']))
+    return items[0]['played_at'] if items else None
 
-    for idx, item in enumerate(items):
-        track = item['track']
-        played_at = parse(item['played_at'])
+def query_played_day( dynamo_client, table_name, date_played ):
 
-        duration_ms = track.get('duration_ms', 0)
-        playback_sec = int(duration_ms) // 1000
-        item['playback_sec'] = playback_sec
+    """
+    Gera as páginas de itens de um dia (partition key), seguindo o LastEvaluatedKey
+    até o fim da partição.
+    """
 
-        if idx < len(items) - 1:
-            next_played_at = parse( items[idx + 1]['played_at'])
-            intervalo_seg = (next_played_at - played_at).total_seconds()
+    projection, names = build_projection( TRACK_PROJECTION )
 
-            item['was_played'] = intervalo_seg >= float(playback_sec) * 0.9 # margem de 90%
-            item['playback_sec'] = min(intervalo_seg, float(playback_sec))
-        else:
-            item['was_played'] = True 
+    paginator = dynamo_client.get_paginator( 'query' )
 
-    kwargs['ti'].xcom_push( key='tracks', value=items )
+    pages = paginator.paginate(
+        TableName=table_name,
+        KeyConditionExpression='date_played = :date',
+        ExpressionAttributeValues={
+            ":date": {'S': date_played}
+        },
+        ProjectionExpression=projection,
+        ExpressionAttributeNames=names
+    )
+
+    for page in pages:
+        yield page['Items']
+
+def build_projection( paths ):
+
+    """
+    Monta a ProjectionExpression com placeholders para cada parte do caminho,
+    evitando conflito com palavras reservadas do DynamoDB (name, uri, ...).
+    """
+
+    names = {}
+    expressions = []
+
+    for path in paths:
+
+        parts = []
+
+        for part in path.split( '.' ):
+            placeholder = f'#{part}'
+            names[placeholder] = part
+            parts.append( placeholder )
+
+        expressions.append( '.'.join( parts ) )
+
+    return ', '.join( expressions ), names
 
 def download_previews( **kwargs ):
 
-    items = kwargs['ti'].xcom_pull( key='tracks', task_ids='extract_tracks' )
+    """
+    Baixa os previews de 30 segundos das faixas em paralelo.
 
-    preview = dict()
+    Cada track_id é baixado uma única vez por execução, usando uma sessão HTTP
+    compartilhada com pool de conexões e um limite de requisições simultâneas por host.
+    Faixas que já estão no PreviewStore persistente não são baixadas novamente, e
+    faixas que já possuem features no Postgres nem precisam de preview.
+    """
 
-    for item in items:
-        
-        track_id = item['track']['id']
-        embed_url = f'https://open.spotify.com/embed/track/{track_id}'
+    items = pull_artifact( kwargs, 'tracks', 'extract_tracks' )
 
-        headers = {"User-Agent": "Mozilla/5.0"}
+    pg_hook = PostgresHook( postgres_conn_id='spotify-postgres' )
 
-        response = requests.get( embed_url, headers=headers )
+    track_ids = list( dict.fromkeys( item['track']['id'] for item in items ) )
 
-        if response.status_code != 200:
-            print( f'Erro ao acessar {embed_url}' )
-            continue
+    known_tracks = get_tracks_with_features( track_ids, pg_hook )
 
-        soup = BeautifulSoup(response.text, "html.parser")
+    kwargs['ti'].xcom_push( key='known_tracks', value=sorted( known_tracks ) )
 
-        script_tag = soup.find( "script", {"id": "__NEXT_DATA__"})
+    track_ids = [ track_id for track_id in track_ids if track_id not in known_tracks ]
 
-        if not script_tag:
-            print('Script __NEXT_DATA__ não encontrado' )
-            continue
+    print( f'[INFO] {len(known_tracks)} faixas já possuem features e não terão o preview baixado.' )
+
+    store = get_preview_store()
+
+    # Só os track_ids vão para o XCom; o arquivo é resolvido pelo store no worker da extração
+    preview = [ track_id for track_id in track_ids if track_id in store ]
+    to_download = [ track_id for track_id in track_ids if track_id not in store ]
+
+    cached = len( preview )
+
+    session = build_http_session( PREVIEW_WORKERS )
+
+    with ThreadPoolExecutor( max_workers=PREVIEW_WORKERS ) as executor:
+        stored = list( executor.map( lambda track_id: fetch_preview( session, store, track_id ), to_download ) )
+
+    session.close()
+    store.save_index()
+
+    preview.extend( track_id for track_id, sha in zip( to_download, stored ) if sha )
+
+    print( f'[INFO] {cached} previews encontrados no store, {len(preview) - cached} de {len(to_download)} baixados.' )
+
+    kwargs['ti'].xcom_push( key='preview_tracks', value=preview )
+
+def get_preview_store():
+
+    """
+    Cria o PreviewStore a partir das Variables preview_store_uri (diretório local ou
+    s3://bucket/prefixo) e preview_store_max_mb.
+    """
+
+    uri = Variable.get( 'preview_store_uri', default_var='s3://personal-spotify-wrapped/previews' )
+    max_bytes = int( Variable.get( 'preview_store_max_mb', default_var=2048 ) ) * 1024 * 1024
+
+    s3_client = S3Hook( aws_conn_id='aws_conn' ).get_conn() if uri.startswith( 's3://' ) else None
+
+    return PreviewStore( uri, max_bytes, s3_client=s3_client )
+
+def fetch_preview( session, store, track_id ):
+
+    """
+    Encontra a URL do preview na página de embed da faixa e salva o MP3 no PreviewStore.
+
+    Retorna o sha256 do preview salvo ou None quando ele não está disponível.
+    """
+
+    embed_url = f'https://open.spotify.com/embed/track/{track_id}'
 
+    headers = {"User-Agent": "Mozilla/5.0"}
+
+    response = http_get( session, embed_url, headers=headers )
+
+    if response is None or response.status_code != 200:
+        print( f'Erro ao acessar {embed_url}' )
+        return None
+
+    try:
+        preview_url = extract_preview_url( response.text )
+
+    except Exception as e:
+        print( f'Erro ao extrair preview de {track_id}: {e}' )
+        return None
+
+    if not preview_url:
+        print( f'Preview não encontrado no __NEXT_DATA__ de {track_id}' )
+        return None
+
+    # Request para baixar o preview
+    preview_response = http_get( session, preview_url )
+
+    if preview_response is None or preview_response.status_code != 200:
+        print( f'Erro ao baixar o preview de {track_id}' )
+        return None
+
+    return store.put( track_id, preview_response.content )
+
+def build_http_session( pool_size ):
+
+    """
+    Cria uma sessão requests com pool de conexões dimensionado para os workers.
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter( pool_connections=pool_size, pool_maxsize=pool_size )
+    session.mount( 'https://', adapter )
+    session.mount( 'http://', adapter )
+
+    return session
+
+def host_semaphore( host ):
+
+    with HOST_SEMAPHORES_LOCK:
+        if host not in HOST_SEMAPHORES:
+            HOST_SEMAPHORES[host] = BoundedSemaphore( PER_HOST_CONCURRENCY )
+        return HOST_SEMAPHORES[host]
+
+def http_get( session, url, max_retries=3, timeout=(5, 30), max_wait=60.0, **kwargs ):
+
+    """
+    GET com timeout, limite de concorrência por host e novas tentativas para erros de
+    conexão, 429 e 5xx. No 429 espera o Retry-After do servidor (até max_wait segundos);
+    nos demais casos usa backoff com jitter. Retorna None se todas as tentativas falharem.
+    """
+
+    semaphore = host_semaphore( urlparse( url ).netloc )
+
+    for attempt in range( max_retries + 1 ):
 
         try:
-            data = json.loads(script_tag.string)
-            preview_url = data["props"]["pageProps"]["state"]["data"]["entity"]["audioPreview"]["url"]
+            with semaphore:
+                response = session.get( url, timeout=timeout, **kwargs )
 
-        except Exception as e:
-            print( f'Erro ao extrair preview de {track_id}: {e}' )
-            continue
+        except requests.RequestException as e:
+            print( f'[WARN] Falha ao acessar {url}: {e}' )
+            response = None
 
-        # Request para baixar o preview
-        preview_response = requests.get( preview_url )
-        
-        if preview_response.status_code == 200:
-            file_path = f'/tmp/{track_id}.mp3'
-            with open( file_path, 'wb' ) as f:
-                f.write( preview_response.content )
-            preview[track_id] = file_path
-    
-    kwargs['ti'].xcom_push( key='preview_files', value=preview )
+        if response is not None and response.status_code != 429 and response.status_code < 500:
+            return response
+
+        if attempt == max_retries:
+            break
+
+        wait = retry_after( response ) if response is not None and response.status_code == 429 else None
+
+        if wait is None:
+            backoff( attempt, base=0.5 )
+        else:
+            sleep( min( wait, max_wait ) )
+
+    status = response.status_code if response is not None else 'sem resposta'
+    print( f'[WARN] {url} falhou após {max_retries + 1} tentativas ({status})' )
+
+    return None
 
 def return_data_by_track_id( track_id, spotify_items ):
 
@@ -400,14 +960,64 @@ def return_data_by_track_id( track_id, spotify_items ):
 
 def extract_audio_features( **kwargs ):
 
-    previews = kwargs['ti'].xcom_pull( key='preview_files', task_ids='download_previews' )
-    spotify_items = kwargs['ti'].xcom_pull( key='tracks', task_ids='extract_tracks' )
+    """
+    Extrai as audio features das faixas que ainda não as possuem no Postgres.
+
+    Cada track_id com preview é analisado uma única vez, pelo ReccoBeatsClient ou pelo
+    engine local (Variable audio_features_engine), e o resultado é replicado para todas
+    as reproduções da faixa.
+    """
 
-    recco_endpoint = "https://api.reccobeats.com/v1/analysis/audio-features"
+    previews = set( kwargs['ti'].xcom_pull( key='preview_tracks', task_ids='download_previews' ) or [] )
+    spotify_items = pull_artifact( kwargs, 'tracks', 'extract_tracks' )
 
-    headers = { 'Accept': 'application/json' }
- 
-    pg_hook = PostgresHook( postgres_conn_id='spotify-postgres' )
+    known_tracks = set( kwargs['ti'].xcom_pull( key='known_tracks', task_ids='download_previews' ) or [] )
+
+    # Materializa os previews neste worker a partir do store (local ou S3)
+    store = get_preview_store()
+
+    pending = {}
+
+    for track_id in previews - known_tracks:
+
+        path = store.get( track_id )
+
+        if path:
+            pending[track_id] = path
+        else:
+            # Sem o arquivo a faixa é salva sem features, como quando não há preview
+            print( f'[WARN] Preview de {track_id} não encontrado no store.' )
+            previews.discard( track_id )
+
+    store.save_index()
+
+    # 'reccobeats': API remota | 'local': cálculo offline com NumPy em um pool de processos
+    engine = Variable.get( 'audio_features_engine', default_var='reccobeats' )
+
+    if engine == 'local':
+
+        # Import tardio: o librosa só é carregado quando o engine local está ativo
+        import local_audio_features
+
+        extracted = local_audio_features.extract_many( pending )
+
+        print( f'[INFO] Features calculadas localmente para {len(extracted)} de {len(pending)} faixas.' )
+
+    else:
+
+        client = ReccoBeatsClient(
+            base_url=Variable.get( 'reccobeats_base_url', default_var='https://api.reccobeats.com' ),
+            max_workers=int( Variable.get( 'reccobeats_workers', default_var=4 ) ),
+            rate=float( Variable.get( 'reccobeats_rate_per_sec', default_var=2 ) )
+        )
+
+        extracted = client.extract_many( pending )
+        client.close()
+
+        print( f'[INFO] Features extraídas para {len(extracted)} de {len(pending)} faixas. Latência: {client.latency_summary()}' )
+
+    # No modo S3 as cópias locais dos previews não são mais necessárias neste worker
+    store.close()
 
     features_data = {}
 
@@ -415,90 +1025,89 @@ def extract_audio_features( **kwargs ):
 
         track = item['track']
         track_id = track['id']
-
-        duration_ms = track.get('duration_ms', 0)
-        playback_sec = item.get('playback_sec') or duration_ms // 1000
-        was_played = item.get('was_played', True)
         played_at = item.get('played_at')
 
-        if verificar_features_extraidas(track_id, pg_hook):
+        if track_id in known_tracks:
             print( f'[INFO] Track {track_id} já possui features. Pulando extração.' )
 
-            features_data[played_at] = {
-                'track': track,
-                'album': track.get('album', {}),
-                'artists': track.get('artists', []),
-                'played_at': played_at,
-                'playback_sec': playback_sec,
-                'was_played': was_played,
-                'audio_features': {}
-            }
+            features_data[played_at] = build_features_entry( item, {} )
             continue
 
-        path = previews.get(track_id)
-        if not path:
+        if track_id not in previews:
             print(f'[WARN] preview não encontrado para a track {track_id} reproduzida em {played_at}, salvando sem features.')
 
-            features_data[played_at] = {
-                'track': track,
-                'album': track.get('album', {}),
-                'artists': track.get('artists', []),
-                'played_at': played_at,
-                'playback_sec': playback_sec,
-                'was_played': was_played,
-                'audio_features': {}
-            }
+            features_data[played_at] = build_features_entry( item, {} )
             continue
-            
-        
-        try:
-            with open( path, 'rb' ) as f:
-                
-                files = {'audioFile': f}
-                response = requests.post( recco_endpoint, files=files, headers=headers)
 
-        except Exception as e:
-            print( f'[ERROR] Falha ao abrir arquivo {path}: {e}' )
+        if track_id not in extracted:
+
+            print( f'[ERROR] Falha na extração de features para {track_id}.' )
             continue
 
-        if response.status_code != 200:
+        features_data[played_at] = build_features_entry( item, extracted[track_id] )
 
-            print( f'[ERROR] Falha na extração de features para {track_id}. Status {response.status_code}' )
-            continue
+    push_artifact( kwargs, 'features_data', list( features_data.values() ) )
 
-        # Obtem as features da API
-        audio_features = response.json()
-
-        features_data[played_at] = {
-            'track': track,
-            'album': track.get('album', {}),
-            'artists': track.get('artists', []),
-            'played_at': played_at,
-            'playback_sec': playback_sec,
-            'was_played': was_played,
-            'audio_features': audio_features
-        }
+def build_features_entry( item, audio_features ):
+
+    track = item['track']
 
-    kwargs['ti'].xcom_push( key='features_data', value=features_data )
+    duration_ms = track.get('duration_ms', 0)
+
+    return {
+        'track': track,
+        'album': track.get('album', {}),
+        'artists': track.get('artists', []),
+        'played_at': item.get('played_at'),
+        'playback_sec': item.get('playback_sec') or duration_ms // 1000,
+        'was_played': item.get('was_played', True),
+        'audio_features': audio_features
+    }
+
+def run_db_migrations():
+
+    """
+    Aplica as migrações pendentes do schema antes da carga no Postgres.
+    """
+
+    hook = PostgresHook( postgres_conn_id='spotify-postgres' )
+    conn = hook.get_conn()
+
+    try:
+        applied = apply_migrations( conn )
+    finally:
+        conn.close()
+
+    if not applied:
+        print( '[INFO] Schema do banco já está atualizado.' )
 
 def insert_into_postgres( **kwargs ):
 
     """
     Insere os dados dos tracks no banco de dados PostgreSQL
 
-    dados_tracks: lista de dicionários contendo dados do DynamoDB + API do ReccoBeats
+    dados_tracks: lista de dicionários contendo dados do DynamoDB + API do ReccoBeats,
+    lida do artefato gravado por extract_audio_features
+
+    As linhas de cada tabela são deduplicadas em memória e gravadas com um único
+    execute_values por tabela, em vez de um INSERT por reprodução.
     """
 
     hook = PostgresHook( postgres_conn_id='spotify-postgres' )
     conn = hook.get_conn()
     cursor = conn.cursor()
 
-    dados_tracks = kwargs['ti'].xcom_pull( key='features_data', task_ids='extract_audio_features' )
+    dados_tracks = pull_artifact( kwargs, 'features_data', 'extract_audio_features' )
+
+    artist_names = {}
+    album_rows = {}
+    track_rows = {}
+    track_artist_rows = set()
+    playback_rows = {}
 
-    for played_at, item in dados_tracks.items():
+    for item in dados_tracks:
 
         track = item.get('track')
-        track_id = track.get('id')
         album = item.get('album', {})
         artists = item.get('artists', [])
         features = item.get('audio_features', {}) or {}
@@ -506,160 +1115,358 @@ def insert_into_postgres( **kwargs ):
         # Artistas
         for artist in artists:
 
-            artist_id = artist['id']
-
-            img, popularity, followers = get_artist_data(artist_id)
+            artist_names[artist['id']] = artist['name']
 
-            cursor.execute(
-            """
-                INSERT INTO artist (artist_id, name, image_url, popularity, followers)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (artist_id) DO NOTHING;
-            """,
-            (artist['id'], artist['name'], img, popularity, followers)
-            )
+            # Track_Artist
+            track_artist_rows.add( (track['id'], artist['id']) )
 
         # Album
-        album_image = None
+        album_rows.setdefault( album.get('id'), build_album_row( album ) )
 
-        release_date = ''
-        precision = ''
+        # Track
+        track_rows.setdefault( track['id'], (
+            track['id'], track['name'], track['duration_ms'], track['uri'],
+            album.get('id'), track.get('explicit'), track.get('popularity'),
+            features.get('acousticness'), features.get('danceability'), features.get('energy'),
+            features.get('instrumentalness'), features.get('liveness'), features.get('speechiness'),
+            features.get('valence'), features.get('tempo')
+        ))
 
-        if isinstance( album, dict ):
-            
-            if album and isinstance( album.get('images'), list):
-                album_image = next( ( img['url'] for img in album['images'] if img.get( 'width') == 300 ), None )
+        # Playback History
+        played_at = item.get('played_at')
 
-            release_date = album.get('release_date')
-            precision = album.get('release_date_precision')
-        else:
-            album_image = ''
-            release_date = ''
-            precision = ''
+        playback_rows[played_at] = (
+            track['id'], played_at,
+            item.get('playback_sec'), item.get('was_played', True),
+            track.get('popularity')
+        )
 
-        if release_date:
-            if precision == 'year':
-                release_date = f'{release_date}-01-01'
-            elif precision == 'month':
-                release_date = f'{release_date}-01'
+    # Somente artistas novos ou com o refresh expirado são buscados na API
+    artists_data = get_artists_data( list( artist_names ), cursor )
 
-        cursor.execute(
-            """
-                INSERT INTO album (album_id, name, release_date, total_tracks, album_type, image_url)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (album_id) DO NOTHING;
-            """,
-            (
-                album.get('id'),
-                album.get('name'),
-                release_date,
-                album.get('total_tracks'),
-                album.get('album_type'),
-                album_image
-            )
-        )
+    artist_rows = {
+        artist_id: (artist_id, artist_names.get( artist_id, name ), img, popularity, followers, fetched_at)
+        for artist_id, ((name, img, popularity, followers), fetched_at) in artists_data.items()
+    }
 
-        # Track
-        cursor.execute(
+    execute_values(
+        cursor,
+        """
+            INSERT INTO artist (artist_id, name, image_url, popularity, followers, refreshed_at)
+            VALUES %s
+            ON CONFLICT (artist_id) DO UPDATE
+            SET image_url = EXCLUDED.image_url,
+                popularity = EXCLUDED.popularity,
+                followers = EXCLUDED.followers,
+                refreshed_at = EXCLUDED.refreshed_at;
+        """,
+        list( artist_rows.values() ),
+        page_size=1000
+    )
+
+    execute_values(
+        cursor,
+        """
+            INSERT INTO album (album_id, name, release_date, total_tracks, album_type, image_url)
+            VALUES %s
+            ON CONFLICT (album_id) DO NOTHING;
+        """,
+        list( album_rows.values() ),
+        page_size=1000
+    )
+
+    execute_values(
+        cursor,
         """
             INSERT INTO track (
                 track_id, name, duration_ms, uri, album_id, explicit, popularity,
                 acousticness, danceability, energy, instrumentalness,
                 liveness, speechiness, valence, tempo
             )
-            VALUES (
-                %s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s, %s, %s, %s
-            )
+            VALUES %s
             ON CONFLICT (track_id) DO NOTHING;
         """,
-        (
-            track['id'], track['name'], track['duration_ms'], track['uri'],
-            album.get('id'), track.get('explicit'), track.get('popularity'),
-            features.get('acousticness'), features.get('danceability'), features.get('energy'),
-            features.get('instrumentalness'), features.get('liveness'), features.get('speechiness'),
-            features.get('valence'), features.get('tempo')
-        ))
+        list( track_rows.values() ),
+        page_size=1000
+    )
 
+    execute_values(
+        cursor,
+        """
+            INSERT INTO track_artist (track_id, artist_id)
+            VALUES %s
+            ON CONFLICT DO NOTHING;
+        """,
+        list( track_artist_rows ),
+        page_size=1000
+    )
 
-        # Track_Artist
-        for artist in artists:
+    execute_values(
+        cursor,
+        """
+            INSERT INTO playback_history (track_id, played_at, playback_sec, was_played, popularity)
+            VALUES %s
+            ON CONFLICT (played_at) DO NOTHING;
+        """,
+        list( playback_rows.values() ),
+        page_size=1000
+    )
 
-            cursor.execute(
+    print( f'[INFO] Inseridos {len(playback_rows)} reproduções, {len(track_rows)} faixas, {len(album_rows)} álbuns e {len(artist_rows)} artistas.' )
+
+    # Finaliza a última reprodução da execução anterior, salva com valores provisórios
+    correction = kwargs['ti'].xcom_pull( key='playback_correction', task_ids='extract_tracks' )
+
+    if correction:
+
+        cursor.execute(
             """
-                INSERT INTO track_artist (track_id, artist_id)
-                VALUES (%s, %s)
-                ON CONFLICT DO NOTHING;
+                UPDATE playback_history
+                SET playback_sec = %s, was_played = %s
+                WHERE played_at = %s;
             """,
-            (
-                track['id'], artist['id']
-            ))
+            ( correction['playback_sec'], correction['was_played'], correction['played_at'] )
+        )
 
-        
-        # Playback History
-        played_at = item.get('played_at')
-        playback_sec = item.get('playback_sec')
-        was_played = item.get('was_played', True)
+        print( f"[INFO] Reprodução de {correction['played_at']} finalizada: {correction['playback_sec']}s, was_played={correction['was_played']}." )
+
+    # Atualiza os rollups diários apenas dos dias tocados nesta carga
+    touched = list( playback_rows ) + ( [ correction['played_at'] ] if correction else [] )
 
+    refresh_rollups( cursor, touched )
+
+    # Registra a carga na mesma transação; é o que invalida o cache do dashboard
+    if touched:
         cursor.execute(
-        """
-            INSERT INTO playback_history (track_id, played_at, playback_sec, was_played, popularity)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (played_at) DO NOTHING;
-        """,
-        (
-            track['id'], played_at,
-            playback_sec, was_played,
-            track.get('popularity')
-        ))
+            "INSERT INTO pipeline_load (rows, max_played_at) VALUES (%s, %s)",
+            ( len( playback_rows ), max( touched ) )
+        )
 
     conn.commit()
     cursor.close()
     conn.close()
 
+    # O watermark só avança depois que o lote foi gravado
+    new_watermark = kwargs['ti'].xcom_pull( key='playback_watermark', task_ids='extract_tracks' )
+
+    if new_watermark:
+        Variable.set( 'playback_watermark', json.dumps( new_watermark ) )
+
+    # Os artefatos intermediários só servem a esta execução
+    delete_artifacts( kwargs, [ ( 'tracks', 'extract_tracks' ), ( 'features_data', 'extract_audio_features' ) ] )
+
+def build_album_row( album ):
+
+    """
+    Monta a linha da tabela album, normalizando a release_date conforme a precisão.
+    """
+
+    album_image = None
+
+    release_date = ''
+    precision = ''
+
+    if isinstance( album, dict ):
+        
+        if album and isinstance( album.get('images'), list):
+            album_image = next( ( img['url'] for img in album['images'] if img.get( 'width') == 300 ), None )
+
+        release_date = album.get('release_date')
+        precision = album.get('release_date_precision')
+    else:
+        album_image = ''
+        release_date = ''
+        precision = ''
+
+    if release_date:
+        if precision == 'year':
+            release_date = f'{release_date}-01-01'
+        elif precision == 'month':
+            release_date = f'{release_date}-01'
+
+    return (
+        album.get('id'),
+        album.get('name'),
+        release_date,
+        album.get('total_tracks'),
+        album.get('album_type'),
+        album_image
+    )
+
+def push_artifact( context, key, records ):
+
+    """
+    Grava os registros como artefato comprimido (Variable artifact_uri: diretório local
+    ou s3://bucket/prefixo) e envia para o XCom apenas a referência.
+    """
+
+    uri = Variable.get( 'artifact_uri', default_var='s3://personal-spotify-wrapped/artifacts' )
+    compression = Variable.get( 'artifact_compression', default_var='gzip' )
+
+    s3_client = S3Hook( aws_conn_id='aws_conn' ).get_conn() if uri.startswith( 's3://' ) else None
+
+    name = f"{context['dag'].dag_id}/{context['run_id']}/{key}"
+
+    ref = write_artifact( records, uri, name, s3_client=s3_client, compression=compression )
+
+    print( f"[INFO] Artefato {ref['location']} gravado com {ref['count']} registros." )
+
+    context['ti'].xcom_push( key=key, value=ref )
+
+def pull_artifact( context, key, task_ids ):
+
+    ref = context['ti'].xcom_pull( key=key, task_ids=task_ids )
+
+    s3_client = S3Hook( aws_conn_id='aws_conn' ).get_conn() if ref['location'].startswith( 's3://' ) else None
+
+    return read_artifact( ref, s3_client=s3_client )
+
+def delete_artifacts( context, refs ):
+
+    """
+    Remove os artefatos da execução depois da carga no Postgres. Os de execuções que
+    falharam ficam para as reexecuções e para investigação.
+    """
+
+    for key, task_ids in refs:
+
+        ref = context['ti'].xcom_pull( key=key, task_ids=task_ids )
+
+        if not ref:
+            continue
+
+        s3_client = S3Hook( aws_conn_id='aws_conn' ).get_conn() if ref['location'].startswith( 's3://' ) else None
+
+        delete_artifact( ref, s3_client=s3_client )
+
+        print( f"[INFO] Artefato {ref['location']} removido." )
+
 def clean_dynamodb_items( items ):
 
     deserializer = TypeDeserializer()
 
     return [ {k: deserializer.deserialize(v) for k, v in item.items()} for item in items ]
 
-def verificar_features_extraidas( track_id, pg_hook ):
+def get_tracks_with_features( track_ids, pg_hook ):
+    """
+        Retorna o conjunto de track_ids cujos audio_features já foram extraídos
+        anteriormente, com uma única consulta ao Postgres.
+    """
+    if not track_ids:
+        return set()
+
+    sql = "SELECT track_id FROM track WHERE track_id = ANY(%s)"
+    rows = pg_hook.get_records( sql, parameters=( list( track_ids ), ) )
+    return { row[0] for row in rows }
+
+def get_artists_data( artist_ids, cursor ):
+
     """
-        Verificar se os audio_features da track já foram extraídos anteriormente.
+    Retorna {artist_id: ((name, image_url, popularity, followers), buscado_em)} apenas
+    para os artistas que precisam ser gravados na tabela artist.
+
+    O TTL (Variable artist_cache_ttl_hours) vale por artista, pela coluna refreshed_at:
+    artistas da carga gravados há menos que o TTL são ignorados com uma única consulta.
+    Além deles, até artist_refresh_batch artistas com o refresh mais antigo entram na
+    carga mesmo sem terem sido tocados, para que ninguém fique desatualizado para sempre.
+    Os demais são buscados em lotes de 50 no endpoint /v1/artists, passando antes pelo
+    LRU em memória, que só serve entradas ainda dentro do TTL.
     """
-    sql = "SELECT 1 FROM track WHERE track_id = %s LIMIT 1"
-    result = pg_hook.get_first( sql, parameters=( track_id, ) )
-    return result is not None
 
-def get_artist_data(artist_id):
+    ttl = timedelta( hours=float( Variable.get( 'artist_cache_ttl_hours', default_var=168 ) ) )
+    batch = int( Variable.get( 'artist_refresh_batch', default_var=200 ) )
+
+    now = datetime.now( timezone.utc )
+
+    cursor.execute(
+        "SELECT artist_id FROM artist WHERE artist_id = ANY(%s) AND refreshed_at >= %s",
+        ( artist_ids, now - ttl )
+    )
+    known = { row[0] for row in cursor.fetchall() }
+
+    cursor.execute(
+        """
+            SELECT artist_id FROM artist
+            WHERE refreshed_at IS NULL OR refreshed_at < %s
+            ORDER BY refreshed_at NULLS FIRST
+            LIMIT %s
+        """,
+        ( now - ttl, batch )
+    )
+    stale = [ row[0] for row in cursor.fetchall() ]
+
+    result = {}
+    missing = []
+
+    for artist_id in dict.fromkeys( artist_ids + stale ):
+
+        if artist_id in known:
+            continue
+
+        cached = ARTIST_CACHE.get( artist_id )
+
+        if cached and now - cached[1] < ttl:
+            ARTIST_CACHE.move_to_end( artist_id )
+            result[artist_id] = cached
+        else:
+            missing.append( artist_id )
+
+    from_cache = len( result )
+
+    for chunk in chunks( missing, 50 ):
+
+        fetched_at = datetime.now( timezone.utc )
+
+        for artist_id, data in fetch_artists( chunk ).items():
+
+            result[artist_id] = ( data, fetched_at )
+
+            ARTIST_CACHE[artist_id] = result[artist_id]
+            ARTIST_CACHE.move_to_end( artist_id )
+            if len( ARTIST_CACHE ) > ARTIST_CACHE_SIZE:
+                ARTIST_CACHE.popitem( last=False )
+
+    print( f'[INFO] Artistas: {len(known)} atualizados no banco, {len(stale)} com refresh expirado, {from_cache} do cache, {len(missing)} buscados na API.' )
+
+    return result
+
+def fetch_artists( artist_ids ):
+
+    """
+    Busca até 50 artistas em uma única chamada ao endpoint /v1/artists?ids=
+    """
 
     def _request(token):
         headers= {"Authorization": f"Bearer {token}"}
-        url = f'https://api.spotify.com/v1/artists/{artist_id}'
-        return requests.get(url, headers=headers)
+        url = 'https://api.spotify.com/v1/artists'
+        return requests.get(url, params={'ids': ','.join(artist_ids)}, headers=headers)
 
-    access_token = Variable.get("access_token")
-    response = _request(access_token)
+    token_manager = get_token_manager()
+    response = _request(token_manager.get_token())
 
     if response.status_code == 401:
-        print("[WARN] Token expirado. Fazendo refresh...")
-        refresh_spotify_token()
-        access_token = Variable.get("access_token")
-        response = _request(access_token)
+        print("[WARN] Token recusado. Fazendo refresh...")
+        response = _request(token_manager.get_token(force=True))
 
     if response.status_code != 200:
-        raise Exception(f"Erro ao buscar artista {artist_id}: {response.status_code} {response.text}")
-    
-    data = response.json()
-    name = data['name']
+        raise Exception(f"Erro ao buscar artistas {artist_ids}: {response.status_code} {response.text}")
+
+    artists = {}
 
-    images = data.get('images', [])
-    img_url = images[-1]['url'] if images else None
+    for data in response.json().get('artists', []):
 
-    popularity = data.get('popularity')
-    followers = data.get('followers', {}).get('total')
+        if not data:
+            continue
+
+        images = data.get('images', [])
+        img_url = images[-1]['url'] if images else None
+
+        popularity = data.get('popularity')
+        followers = data.get('followers', {}).get('total')
+
+        artists[data['id']] = (data.get('name'), img_url, popularity, followers)
 
-    return img_url, popularity, followers
+    return artists
 
 dag = DAG(  
         dag_id = "spotify_pipeline",
@@ -728,6 +1535,12 @@ extract_audio_features = PythonOperator(
     dag=dag
 )
 
+migrate_db = PythonOperator(
+    task_id='apply_db_migrations',
+    python_callable=run_db_migrations,
+    dag=dag
+)
+
 insert_data = PythonOperator(
     task_id='insert_into_postgres',
     python_callable=insert_into_postgres,
@@ -737,5 +1550,5 @@ insert_data = PythonOperator(
 checar_data >> check_folder
 checar_data >> check_create_s3_folder >> refresh_token >> get_tracks_history >> check_folder
 
-check_folder >> open_files >> extract_tracks >> download_previews >> extract_audio_features >> insert_data
+check_folder >> open_files >> extract_tracks >> download_previews >> extract_audio_features >> migrate_db >> insert_data
 
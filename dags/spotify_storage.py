@@ -0,0 +1,207 @@
+import gzip
+import json
+
+from botocore.exceptions import ClientError
+
+from artifacts import slim
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MANIFEST_NAME = '_manifest.json'
+
+# Formato -> (extensão, ContentType). 'json' é o formato original, indentado e sem compressão.
+SNAPSHOT_FORMATS = {
+    'json': ('.json', 'application/json'),
+    'json.gz': ('.json.gz', 'application/gzip'),
+    'ndjson.gz': ('.ndjson.gz', 'application/gzip'),
+    'json.zst': ('.json.zst', 'application/zstd'),
+    'ndjson.zst': ('.ndjson.zst', 'application/zstd'),
+}
+
+
+def is_snapshot(key):
+
+    return not key.endswith(MANIFEST_NAME) and key.endswith(tuple(extension for extension, _ in SNAPSHOT_FORMATS.values()))
+
+
+def encode_snapshot(data, fmt='json', projection=False):
+
+    """
+    Serializa a lista de reproduções no formato escolhido e retorna (corpo, extensão, ContentType).
+    Com projection=True os campos grandes e não usados (available_markets) são removidos.
+    """
+
+    extension, content_type = SNAPSHOT_FORMATS[fmt]
+
+    if projection:
+        data = slim(data)
+
+    if fmt == 'json':
+        return json.dumps(data, indent=4).encode(), extension, content_type
+
+    if fmt.startswith('ndjson'):
+        body = '\n'.join(json.dumps(item, separators=(',', ':')) for item in data).encode()
+    else:
+        body = json.dumps(data, separators=(',', ':')).encode()
+
+    if fmt.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('O formato zstd requer o pacote zstandard')
+        return zstandard.ZstdCompressor().compress(body), extension, content_type
+
+    return gzip.compress(body), extension, content_type
+
+
+def decode_snapshot(body, key):
+
+    """
+    Lê um snapshot em qualquer um dos formatos, identificado pela extensão da chave.
+    """
+
+    if key.endswith('.gz'):
+        body = gzip.decompress(body)
+    elif key.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('O formato zstd requer o pacote zstandard')
+        body = zstandard.ZstdDecompressor().decompress(body)
+
+    text = body.decode('utf-8')
+
+    if '.ndjson' in key:
+        return [json.loads(line) for line in text.splitlines() if line]
+
+    return json.loads(text)
+
+
+def manifest_key(date_folder):
+
+    return f'arquivos/{date_folder}/{MANIFEST_NAME}'
+
+
+def _get_manifest(s3_client, bucket_name, date_folder):
+
+    """
+    Retorna (entradas, etag) do manifest do dia, ou (None, None) se ele não existir.
+    """
+
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=manifest_key(date_folder))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        raise
+
+    return json.loads(response['Body'].read()), response['ETag']
+
+
+def read_manifest(s3_client, bucket_name, date_folder):
+
+    """
+    Lista de {key, size, etag} dos snapshots do dia, na ordem em que foram gravados.
+    Dias anteriores ao manifest são reconstruídos a partir da listagem do prefixo.
+    """
+
+    entries, _ = _get_manifest(s3_client, bucket_name, date_folder)
+
+    if entries is None:
+        entries = build_manifest_from_listing(s3_client, bucket_name, date_folder)
+
+    return entries
+
+
+def list_snapshots(s3_client, bucket_name, date_folder):
+
+    """
+    Entradas {key, size, etag} de todos os arquivos do dia, percorrendo todas as páginas
+    do list_objects_v2, em ordem de chave.
+    """
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    entries = [
+        {'key': obj['Key'], 'size': obj['Size'], 'etag': obj['ETag']}
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f'arquivos/{date_folder}/')
+        for obj in page.get('Contents', [])
+        if not obj['Key'].endswith(('/', MANIFEST_NAME))
+    ]
+
+    entries.sort(key=lambda entry: entry['key'])
+
+    return entries
+
+
+def build_manifest_from_listing(s3_client, bucket_name, date_folder):
+
+    """
+    Monta e grava o manifest de um dia a partir da listagem do prefixo. A gravação só
+    acontece se o manifest ainda não existir (If-None-Match); se outro processo gravou
+    antes, o manifest dele é relido e prevalece.
+    """
+
+    entries = list_snapshots(s3_client, bucket_name, date_folder)
+
+    if not entries:
+        return entries
+
+    try:
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=manifest_key(date_folder),
+            Body=json.dumps(entries),
+            ContentType='application/json',
+            IfNoneMatch='*'
+        )
+
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+
+        stored, _ = _get_manifest(s3_client, bucket_name, date_folder)
+        if stored is not None:
+            return stored
+
+    return entries
+
+
+def append_to_manifest(s3_client, bucket_name, date_folder, key, size, etag, max_retries=5):
+
+    """
+    Acrescenta um snapshot ao manifest do dia. A escrita é condicional ao ETag lido
+    (If-Match / If-None-Match), então gravações concorrentes não se sobrescrevem.
+    Se o manifest ainda não existir, ele nasce da listagem do prefixo, para não perder
+    os snapshots gravados antes dele.
+    """
+
+    for _ in range(max_retries):
+
+        entries, manifest_etag = _get_manifest(s3_client, bucket_name, date_folder)
+
+        if entries is None:
+            entries = list_snapshots(s3_client, bucket_name, date_folder)
+        elif any(entry['key'] == key for entry in entries):
+            return
+
+        if not any(entry['key'] == key for entry in entries):
+            entries.append({'key': key, 'size': size, 'etag': etag})
+
+        condition = {'IfMatch': manifest_etag} if manifest_etag else {'IfNoneMatch': '*'}
+
+        try:
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=manifest_key(date_folder),
+                Body=json.dumps(entries),
+                ContentType='application/json',
+                **condition
+            )
+            return
+
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+
+    raise RuntimeError(f'Não foi possível atualizar o manifest de {date_folder} após {max_retries} tentativas')
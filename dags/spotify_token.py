@@ -0,0 +1,82 @@
+import time
+
+from threading import Lock
+
+import requests
+
+
+TOKEN_URL = 'https://accounts.spotify.com/api/token'
+
+
+class SpotifyTokenManager:
+
+    """
+    Mantém o access_token do Spotify em memória junto com o prazo de expiração.
+
+    O armazenamento persistente é injetado por `load` e `save` (Variables do Airflow na
+    DAG, arquivo .env no scraper), então o mesmo gerenciador serve aos dois. O token só
+    é renovado quando faltam menos de `refresh_margin` segundos para expirar (ou quando
+    forçado após um 401), sob um lock para que threads concorrentes façam um único refresh.
+    """
+
+    def __init__(self, load, save, client_id, client_secret, refresh_margin=300) -> None:
+
+        self.load = load
+        self.save = save
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+
+        self.lock = Lock()
+        self.state = None
+
+    def _expiring(self):
+
+        return (
+            not self.state
+            or not self.state.get('access_token')
+            or float(self.state.get('expires_at') or 0) - time.time() < self.refresh_margin
+        )
+
+    def get_token(self, force=False):
+
+        """
+        Retorna um access_token válido, renovando-o apenas se necessário.
+        """
+
+        with self.lock:
+
+            if self.state is None:
+                self.state = self.load()
+
+            if force or self._expiring():
+                self._refresh()
+
+            return self.state['access_token']
+
+    def _refresh(self):
+
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': self.state['refresh_token'],
+            'client_id': self.client_id,
+            'client_secret': self.client_secret
+        }
+
+        response = requests.post(TOKEN_URL, data=data, timeout=(5, 30))
+
+        if response.status_code != 200:
+            raise RuntimeError(f'Falha ao renovar o access_token: {response.status_code} {response.text}')
+
+        payload = response.json()
+
+        self.state = {
+            'access_token': payload['access_token'],
+            # O Spotify nem sempre devolve um novo refresh_token
+            'refresh_token': payload.get('refresh_token') or self.state['refresh_token'],
+            'expires_at': time.time() + int(payload.get('expires_in', 3600))
+        }
+
+        self.save(self.state)
+
+        print(f"Novo access_token obtido, válido até {time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(self.state['expires_at']))}")
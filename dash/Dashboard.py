@@ -2,16 +2,16 @@ import streamlit as st
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
-import matplotlib.image as mpimg
-import requests
-from io import BytesIO
 from datetime import datetime
 
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from sqlalchemy import text
-from utils_spotify import get_engine, default_page_config, SPOTIFY_BG
+from utils_spotify import (
+    get_engine, default_page_config, SPOTIFY_BG,
+    load_artist_names, load_dashboard_facts, dashboard_aggregates
+)
+from image_cache import prefetch
 
 # -------------------------------------------
 # Configuração inicial
@@ -53,11 +53,7 @@ engine = get_engine()
 # Filtros
 # -------------------------------------------
 
-sql_artists = text("SELECT DISTINCT name FROM artist ORDER BY name;")
-df_artists = pd.DataFrame()
-if engine:
-    with engine.begin() as conn:
-        df_artists = pd.read_sql(sql_artists, conn)
+artist_names = load_artist_names(engine) if engine else []
 
 with st.sidebar:
     st.markdown("### Filtros")
@@ -70,7 +66,7 @@ with st.sidebar:
 
     artistas_sel = st.multiselect(
         "Filtrar por artista(s)",
-        options=df_artists['name'].tolist(),
+        options=artist_names,
         default=[]
     )
 
@@ -79,48 +75,21 @@ if isinstance(periodo, (list, tuple)) and len(periodo) == 2:
 else:
     start_date, end_date = datetime(2025, 1, 1), datetime(2025, 9, 1)
 
-# Params para query
-extra = {}
-if artistas_sel:
-    extra["artistas"] = artistas_sel
-
-params = {
-    "ds": str(start_date),
-    "de": str(end_date),
-    **extra
-}
-
 st.session_state['periodo'] = periodo
 st.session_state['artistas_sel'] = artistas_sel
 
 # -------------------------------------------
-# KPIs
+# Dados do período (uma consulta, em cache) e agregados
 # -------------------------------------------
-clause = ""
-extra = {}
-if artistas_sel:
-    clause = "AND a.name = ANY(:artists)"
-    extra = {"artists": artistas_sel}
-
-sql_kpi = text(f"""
-    SELECT
-        COUNT(DISTINCT a.artist_id) AS num_artists,
-        COUNT(DISTINCT t.track_id)  AS num_tracks,
-        SUM(ph.playback_sec)/3600.0 AS hours
-    FROM playback_history ph
-    JOIN track t ON t.track_id = ph.track_id
-    JOIN track_artist ta ON ta.track_id = t.track_id
-    JOIN artist a ON a.artist_id = ta.artist_id
-    WHERE ph.played_at::date BETWEEN :ds AND :de
-    {clause}
-""")
-
-params = {"ds": str(start_date), "de": str(end_date), **extra}
-
-df_kpi = pd.DataFrame()
+aggregates = {}
 if engine:
-    with engine.begin() as conn:
-        df_kpi = pd.read_sql(sql_kpi, conn, params=params)
+    facts = load_dashboard_facts(engine, start_date, end_date)
+    aggregates = dashboard_aggregates(facts, artistas_sel)
+
+# -------------------------------------------
+# KPIs
+# -------------------------------------------
+df_kpi = aggregates.get("kpi", pd.DataFrame())
 
 if not df_kpi.empty:
 
@@ -148,19 +117,7 @@ if not df_kpi.empty:
 # Músicas Skipadas
 # -------------------------------------------
 
-sql_skip = text(f"""
-    SELECT 
-        SUM(CASE WHEN was_played = FALSE THEN 1 ELSE 0 END) AS skipadas,
-        SUM(CASE WHEN was_played = TRUE THEN 1 ELSE 0 END) AS completadas
-    FROM playback_history ph
-    WHERE ph.played_at::date BETWEEN :ds AND :de
-    {clause if clause else ""}
-""")
-
-df_skip = pd.DataFrame()
-if engine:
-    with engine.begin() as conn:
-        df_skip = pd.read_sql(sql_skip, conn, params=params)
+df_skip = aggregates.get("skip", pd.DataFrame())
 
 if not df_skip.empty:
     df_donut = df_skip.melt(var_name="status", value_name="qtd")
@@ -184,23 +141,7 @@ if not df_skip.empty:
 # -------------------------------------------
 # Tendência mensal
 # -------------------------------------------
-sql_trend = text(f"""
-    SELECT ph.played_at::date as dia,
-       SUM(ph.playback_sec)/3600.0 AS horas
-    FROM playback_history ph
-        JOIN track t ON t.track_id = ph.track_id
-        JOIN track_artist ta ON ta.track_id = t.track_id
-        JOIN artist a ON a.artist_id = ta.artist_id
-    WHERE ph.played_at::date BETWEEN :ds AND :de
-    {clause}
-    GROUP BY dia
-    ORDER BY dia;
-""")
-
-df_trend = pd.DataFrame()
-if engine:
-    with engine.begin() as conn:
-        df_trend = pd.read_sql(sql_trend, conn, params=params)
+df_trend = aggregates.get("trend", pd.DataFrame())
 
 if not df_trend.empty:
     st.subheader("⏱️ Horas de Escuta por Dia")
@@ -238,25 +179,7 @@ with xcol2:
 # -------------------------------------------
 # Top 6 Artistas (grid estilo Spotify Wrapped)
 # -------------------------------------------
-sql_top_artists = text(f"""
-    SELECT a.name,
-       COALESCE(a.image_url, 'https://via.placeholder.com/120') AS image_url,
-       SUM(ph.playback_sec)/60.0 AS minutes
-    FROM playback_history ph
-        JOIN track t ON t.track_id = ph.track_id
-        JOIN track_artist ta ON ta.track_id = t.track_id
-        JOIN artist a ON a.artist_id = ta.artist_id
-    WHERE ph.played_at::date BETWEEN :ds AND :de
-    {clause}
-    GROUP BY a.name, a.image_url
-    ORDER BY minutes DESC
-    LIMIT 6;
-""")
-
-df_top_artists = pd.DataFrame()
-if engine:
-    with engine.begin() as conn:
-        df_top_artists = pd.read_sql(sql_top_artists, conn, params=params)
+df_top_artists = aggregates.get("top_artists", pd.DataFrame())
 
 def render_top_artists(df_top):
     # --- Ajustes que você pode mexer ---
@@ -271,6 +194,9 @@ def render_top_artists(df_top):
     hspace_val = 0.6     # espaço vertical entre linhas
     # -----------------------------------
 
+    # Thumbnails baixados em paralelo e reaproveitados do cache (memória/disco)
+    images = prefetch(df_top["image_url"].tolist())
+
     fig, axes = plt.subplots(2, 3, figsize=(12, 6), facecolor="none")
     axes = axes.flatten()
 
@@ -283,11 +209,7 @@ def render_top_artists(df_top):
         rank = i + 1
         name = row["name"]
         minutes = int(row["minutes"])
-        img_url = row["image_url"] or "https://via.placeholder.com/120"
-
-        # Baixar imagem
-        response = requests.get(img_url)
-        img = mpimg.imread(BytesIO(response.content), format="jpg")
+        img = images[row["image_url"]]
 
         # Número grande no fundo
         ax.text(rank_x_offset, rank_y_offset, str(rank),
@@ -326,21 +248,7 @@ def render_top_artists(df_top):
 # -------------------------------------------
 # Top 5 Tracks (estilo Spotify Wrapped)
 # -------------------------------------------
-sql_top_tracks = text(f"""
-    SELECT t.name, SUM(ph.playback_sec)/60.0 AS minutes
-    FROM playback_history ph
-    JOIN track t ON t.track_id = ph.track_id
-    JOIN track_artist ta ON ta.track_id = t.track_id
-    JOIN artist a ON a.artist_id = ta.artist_id
-    WHERE ph.played_at::date BETWEEN :ds AND :de
-    {clause}
-    GROUP BY t.name ORDER BY minutes DESC LIMIT 5
-""")
-
-df_top_tracks = pd.DataFrame()
-if engine:
-    with engine.begin() as conn:
-        df_top_tracks = pd.read_sql(sql_top_tracks, conn, params=params)
+df_top_tracks = aggregates.get("top_tracks", pd.DataFrame())
 
 def render_top_tracks(df_top):
     st.subheader("🎵 Top 5 Tracks")
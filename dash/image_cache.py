@@ -0,0 +1,132 @@
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from threading import Lock
+from urllib.parse import urlparse
+
+import numpy as np
+import requests
+from PIL import Image, ImageDraw, ImageOps
+
+# Thumbnails circulares (PNG com alpha) em disco, chaveados pelo hash da URL
+CACHE_DIR = Path(os.environ.get("SPOTIFY_IMAGE_CACHE", Path.home() / ".cache" / "spotify_wrapped" / "images"))
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+THUMB_SIZE = 300
+MEMORY_ENTRIES = 64
+PREFETCH_WORKERS = 6
+
+PLACEHOLDER_HOST = "via.placeholder.com"
+PLACEHOLDER_COLOR = (40, 40, 40)
+
+_memory = OrderedDict()
+_memory_lock = Lock()
+_disk_lock = Lock()
+_session = requests.Session()
+
+
+def _cache_path(url):
+    return CACHE_DIR / f"{hashlib.sha256(url.encode()).hexdigest()}.png"
+
+def _circular(img):
+    """
+    Recorta a imagem no quadrado central, redimensiona e aplica a máscara circular no alpha.
+    """
+    img = ImageOps.fit(img.convert("RGB"), (THUMB_SIZE, THUMB_SIZE), Image.LANCZOS)
+
+    mask = Image.new("L", (THUMB_SIZE, THUMB_SIZE), 0)
+    ImageDraw.Draw(mask).ellipse((0, 0, THUMB_SIZE - 1, THUMB_SIZE - 1), fill=255)
+
+    img.putalpha(mask)
+    return img
+
+def placeholder():
+    """
+    Círculo cinza gerado localmente, no lugar do via.placeholder.com.
+    """
+    return _circular(Image.new("RGB", (THUMB_SIZE, THUMB_SIZE), PLACEHOLDER_COLOR))
+
+def _remember(url, array):
+    with _memory_lock:
+        _memory[url] = array
+        _memory.move_to_end(url)
+        while len(_memory) > MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+    return array
+
+def _evict():
+    """
+    Remove os thumbnails menos usados (mtime mais antigo) até caber em CACHE_MAX_BYTES.
+    """
+    files = sorted(CACHE_DIR.glob("*.png"), key=lambda path: path.stat().st_mtime)
+    total = sum(path.stat().st_size for path in files)
+
+    for path in files:
+        if total <= CACHE_MAX_BYTES:
+            break
+        total -= path.stat().st_size
+        path.unlink(missing_ok=True)
+
+def _load(url):
+    """
+    Retorna (thumbnail, cacheável). Vem do disco se existir, senão do download. Falhas
+    viram placeholder não cacheável (nem em disco nem em memória), para tentar de novo
+    no próximo render.
+    """
+    if not url or urlparse(url).hostname == PLACEHOLDER_HOST:
+        return np.asarray(placeholder()), True
+
+    path = _cache_path(url)
+
+    if path.exists():
+        # Toca o mtime para a ordem de uso do LRU em disco
+        os.utime(path)
+        return np.asarray(Image.open(path)), True
+
+    try:
+        response = _session.get(url, timeout=(3, 10))
+        response.raise_for_status()
+        thumb = _circular(Image.open(BytesIO(response.content)))
+    except (requests.RequestException, OSError) as e:
+        print(f"[WARN] Falha ao baixar imagem {url}: {e}")
+        return np.asarray(placeholder()), False
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.{id(thumb)}.tmp")
+    thumb.save(tmp, format="PNG")
+    tmp.replace(path)
+
+    with _disk_lock:
+        _evict()
+
+    return np.asarray(thumb), True
+
+def get_image(url):
+    """
+    Thumbnail circular (array RGBA) da URL, servido da memória quando possível.
+    """
+    with _memory_lock:
+        if url in _memory:
+            _memory.move_to_end(url)
+            return _memory[url]
+
+    array, cacheable = _load(url)
+    return _remember(url, array) if cacheable else array
+
+def prefetch(urls):
+    """
+    Carrega em paralelo os thumbnails que não estão em memória e retorna {url: array}.
+    """
+    with _memory_lock:
+        missing = list(dict.fromkeys(url for url in urls if url not in _memory))
+
+    loaded = {}
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(PREFETCH_WORKERS, len(missing))) as executor:
+            for url, (array, cacheable) in zip(missing, executor.map(_load, missing)):
+                loaded[url] = _remember(url, array) if cacheable else array
+
+    return {url: loaded[url] if url in loaded else get_image(url) for url in urls}
@@ -4,7 +4,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from sqlalchemy import text
-from utils_spotify import get_engine, get_filters
+from utils_spotify import get_engine, get_filters, read_sql_cached, played_at_filter
 
 # ===============================
 # Configuração da Página
@@ -33,7 +33,7 @@ sql_scatter = text(f"""
     JOIN track t ON t.track_id = ph.track_id
     JOIN track_artist ta ON ta.track_id = t.track_id
     JOIN artist a ON a.artist_id = ta.artist_id
-    WHERE ph.played_at::date BETWEEN :ds AND :de
+    WHERE {played_at_filter()}
     {clause}
     GROUP BY t.popularity
     ORDER BY t.popularity
@@ -41,8 +41,7 @@ sql_scatter = text(f"""
 
 df_scatter = pd.DataFrame()
 if engine:
-    with engine.begin() as conn:
-        df_scatter = pd.read_sql(sql_scatter, conn, params=params)
+    df_scatter = read_sql_cached(engine, sql_scatter, params)
 
 # ===============================
 # Query para Horas x Dias (Heatmap)
@@ -56,7 +55,7 @@ sql_heatmap = text(f"""
     JOIN track t ON t.track_id = ph.track_id
     JOIN track_artist ta ON ta.track_id = t.track_id
     JOIN artist a ON a.artist_id = ta.artist_id
-    WHERE ph.played_at::date BETWEEN :ds AND :de
+    WHERE {played_at_filter()}
     {clause}
     GROUP BY dia_semana, hora
     ORDER BY hora, dia_semana
@@ -64,8 +63,7 @@ sql_heatmap = text(f"""
 
 df_heatmap = pd.DataFrame()
 if engine:
-    with engine.begin() as conn:
-        df_heatmap = pd.read_sql(sql_heatmap, conn, params=params)
+    df_heatmap = read_sql_cached(engine, sql_heatmap, params)
 
 # ===============================
 # Plot: Scatter Popularidade vs Frequência
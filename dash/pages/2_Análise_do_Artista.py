@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 from sqlalchemy import text
-from utils_spotify import get_engine, get_filters
+from utils_spotify import get_engine, get_filters, read_sql_cached, played_at_filter
 
 st.set_page_config(page_title="Análise do Artista", layout="wide")
 
@@ -22,8 +22,7 @@ engine = get_engine()
 sql_artists = text("SELECT DISTINCT name FROM artist ORDER BY name;")
 df_artists = pd.DataFrame()
 if engine:
-    with engine.begin() as conn:
-        df_artists = pd.read_sql(sql_artists, conn)
+    df_artists = read_sql_cached(engine, sql_artists)
 
 artista_sel = st.sidebar.selectbox(
     "Escolha um artista",
@@ -44,10 +43,9 @@ if artista_sel and engine:
         LIMIT 1;
     """)
     img_url = None
-    with engine.begin() as conn:
-        res = conn.execute(sql_img, {"artista": artista_sel}).fetchone()
-        if res:
-            img_url = res[0]
+    df_img = read_sql_cached(engine, sql_img, {"artista": artista_sel})
+    if not df_img.empty:
+        img_url = df_img["image_url"].iloc[0]
 
     # Mostrar foto do artista ao lado do nome
     col1, col2 = st.columns([1, 4])
@@ -70,13 +68,12 @@ if artista_sel and engine:
         JOIN track_artist ta ON ta.track_id = t.track_id
         JOIN artist a ON a.artist_id = ta.artist_id
         WHERE a.name = :artista
-          AND ph.played_at::date BETWEEN :ds AND :de
+          AND {played_at_filter()}
         {clause if clause else ""}
     """)
 
     df_kpi = pd.DataFrame()
-    with engine.begin() as conn:
-        df_kpi = pd.read_sql(sql_kpi, conn, params=params_local)
+    df_kpi = read_sql_cached(engine, sql_kpi, params_local)
 
     if not df_kpi.empty:
         col1, col2, col3 = st.columns(3)
@@ -97,15 +94,14 @@ if artista_sel and engine:
         JOIN track_artist ta ON ta.track_id = t.track_id
         JOIN artist a ON a.artist_id = ta.artist_id
         WHERE a.name = :artista
-          AND ph.played_at::date BETWEEN :ds AND :de
+          AND {played_at_filter()}
         {clause if clause else ""}
         ORDER BY ph.played_at DESC
         LIMIT 20
     """)
 
     df_tracks = pd.DataFrame()
-    with engine.begin() as conn:
-        df_tracks = pd.read_sql(sql_tracks, conn, params=params_local)
+    df_tracks = read_sql_cached(engine, sql_tracks, params_local)
 
     st.subheader("Últimas Músicas Reproduzidas")
     if not df_tracks.empty:
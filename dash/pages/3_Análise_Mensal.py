@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 from sqlalchemy import text
-from utils_spotify import get_engine, get_filters
+from utils_spotify import get_engine, get_filters, read_sql_cached, day_filter
 
 st.set_page_config(page_title="Análise Mensal", layout="wide")
 
@@ -22,13 +22,11 @@ engine = get_engine()
 # ===============================
 sql_month = text(f"""
     SELECT 
-        DATE_TRUNC('month', ph.played_at)::date AS mes,
-        SUM(ph.playback_sec)/60.0 AS minutos
-    FROM playback_history ph
-    JOIN track t ON t.track_id = ph.track_id
-    JOIN track_artist ta ON ta.track_id = t.track_id
-    JOIN artist a ON a.artist_id = ta.artist_id
-    WHERE ph.played_at::date BETWEEN :ds AND :de
+        DATE_TRUNC('month', da.day)::date AS mes,
+        SUM(da.seconds)/60.0 AS minutos
+    FROM daily_artist da
+    JOIN artist a ON a.artist_id = da.artist_id
+    WHERE {day_filter("da")}
     {clause if clause else ""}
     GROUP BY mes
     ORDER BY mes
@@ -36,8 +34,7 @@ sql_month = text(f"""
 
 df_month = pd.DataFrame()
 if engine:
-    with engine.begin() as conn:
-        df_month = pd.read_sql(sql_month, conn, params=params)
+    df_month = read_sql_cached(engine, sql_month, params)
 
 # ===============================
 # Preparar dados
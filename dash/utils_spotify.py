@@ -1,6 +1,9 @@
+import time
+
 import streamlit as st
 import pandas as pd
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.sql import bindparam
 
 SPOTIFY_BG = "#0B0F14"
@@ -25,22 +28,139 @@ def get_engine():
         pool_pre_ping=True
     )
 
-@st.cache_data(ttl=300, show_spinner=False)
-def load_artists(_engine, start_date, end_date):
-    sql = text("""
+@st.cache_data(ttl=10, show_spinner=False)
+def data_version(_engine):
+    """
+    Versão dos dados: o último load_id gravado pelo insert_into_postgres em pipeline_load.
+    Sem essa tabela (migração 4 ainda não aplicada) cai numa janela de 5 minutos.
+    O cache de 10s faz todas as consultas de um rerun compartilharem uma única checagem.
+    """
+    try:
+        with _engine.begin() as conn:
+            return conn.execute(text("SELECT MAX(load_id) FROM pipeline_load")).scalar()
+    except ProgrammingError:
+        return f"ttl-{int(time.time() // 300)}"
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _read_sql(_engine, sql, params, version):
+    with _engine.begin() as conn:
+        return pd.read_sql(text(sql), conn, params=params)
+
+def read_sql_cached(engine, sql, params=None):
+    """
+    pd.read_sql com cache por (SQL normalizado, parâmetros, versão dos dados).
+    Entre cargas da DAG todas as páginas saem do cache; uma carga nova muda a versão.
+    """
+    sql = " ".join(str(sql).split())
+    return _read_sql(engine, sql, params or {}, data_version(engine))
+
+def played_at_filter(alias="ph"):
+    """
+    Filtro de período semiaberto sobre played_at (>= início, < fim + 1 dia).
+    Ao contrário de played_at::date BETWEEN, permite range scan no índice de played_at.
+    """
+    return f"{alias}.played_at >= CAST(:ds AS date) AND {alias}.played_at < CAST(:de AS date) + 1"
+
+def day_filter(alias):
+    """
+    Filtro de período sobre a coluna day dos rollups diários (daily_*).
+    """
+    return f"{alias}.day BETWEEN CAST(:ds AS date) AND CAST(:de AS date)"
+
+def load_artists(engine, start_date, end_date):
+    sql = f"""
         SELECT DISTINCT a.name AS artist_name
         FROM playback_history ph
             JOIN track t ON t.track_id = ph.track_id
             JOIN track_artist ta ON ta.track_id = t.track_id
             JOIN artist a ON a.artist_id = ta.artist_id
-        WHERE ph.played_at::date BETWEEN :ds AND :de
+        WHERE {played_at_filter()}
         ORDER BY a.name
         LIMIT 2000;
-    """)
-    with _engine.begin() as conn:
-        df = pd.read_sql(sql, conn, params={"ds": str(start_date), "de": str(end_date)})
+    """
+    df = read_sql_cached(engine, sql, {"ds": str(start_date), "de": str(end_date)})
     return df["artist_name"].tolist()
 
+def load_artist_names(engine):
+    df = read_sql_cached(engine, "SELECT DISTINCT name FROM artist ORDER BY name;")
+    return df["name"].tolist()
+
+def load_dashboard_facts(engine, start_date, end_date):
+    """
+    Fatos do período em uma única consulta, no grão (dia, faixa, artista) dos rollups.
+    O filtro de artistas é aplicado em pandas, então trocar a seleção não volta ao banco.
+    """
+    sql = f"""
+        SELECT dt.day,
+               dt.track_id,
+               t.name AS track_name,
+               a.artist_id,
+               a.name AS artist_name,
+               a.image_url,
+               dt.seconds,
+               dt.plays,
+               dt.skips
+        FROM daily_track dt
+            JOIN track t ON t.track_id = dt.track_id
+            JOIN track_artist ta ON ta.track_id = dt.track_id
+            JOIN artist a ON a.artist_id = ta.artist_id
+        WHERE {day_filter("dt")};
+    """
+    return read_sql_cached(engine, sql, {"ds": str(start_date), "de": str(end_date)})
+
+def dashboard_aggregates(facts, artists=None):
+    """
+    Calcula, a partir dos fatos, os mesmos agregados que o Dashboard consultava
+    separadamente: KPIs, skips, horas por dia, top 6 artistas e top 5 faixas.
+    """
+    if artists:
+        facts = facts[facts["artist_name"].isin(artists)]
+
+    # Skips são por reprodução, então cada (dia, faixa) conta uma única vez
+    plays = facts.drop_duplicates(["day", "track_id"])
+    skips = int(plays["skips"].sum())
+
+    kpi = pd.DataFrame({
+        "num_artists": [facts["artist_id"].nunique()],
+        "num_tracks": [facts["track_id"].nunique()],
+        "hours": [facts["seconds"].sum() / 3600.0],
+    })
+
+    skip = pd.DataFrame({
+        "skipadas": [skips],
+        "completadas": [int(plays["plays"].sum()) - skips],
+    })
+
+    trend = facts.groupby("day", as_index=False)["seconds"].sum().sort_values("day")
+    trend = pd.DataFrame({"dia": trend["day"], "horas": trend["seconds"] / 3600.0})
+
+    top_artists = (
+        facts.assign(image_url=facts["image_url"].fillna("https://via.placeholder.com/120"))
+        .groupby(["artist_name", "image_url"], as_index=False)["seconds"].sum()
+        .nlargest(6, "seconds")
+        .reset_index(drop=True)
+    )
+    top_artists = pd.DataFrame({
+        "name": top_artists["artist_name"],
+        "image_url": top_artists["image_url"],
+        "minutes": top_artists["seconds"] / 60.0,
+    })
+
+    top_tracks = (
+        facts.groupby("track_name", as_index=False)["seconds"].sum()
+        .nlargest(5, "seconds")
+        .reset_index(drop=True)
+    )
+    top_tracks = pd.DataFrame({"name": top_tracks["track_name"], "minutes": top_tracks["seconds"] / 60.0})
+
+    return {
+        "kpi": kpi,
+        "skip": skip,
+        "trend": trend,
+        "top_artists": top_artists,
+        "top_tracks": top_tracks,
+    }
+
 def artist_clause_and_params(artists):
     """Retorn (clause, bind) para IN :artists quando houver filtro"""
     if artists:
@@ -0,0 +1,65 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'dags'))
+
+import local_audio_features  # noqa: E402
+from reccobeats_client import ReccoBeatsClient  # noqa: E402
+
+
+FIELDS = ['acousticness', 'danceability', 'energy', 'instrumentalness',
+          'liveness', 'speechiness', 'valence', 'tempo']
+
+
+def main():
+
+    """
+    Compara o engine local com a API do ReccoBeats em uma pasta de previews:
+    python scripts/bench_audio_features.py <pasta_com_mp3> [--offline]
+    """
+
+    folder = Path(sys.argv[1])
+    offline = '--offline' in sys.argv
+
+    previews = {p.stem: str(p) for p in sorted(folder.glob('*.mp3'))}
+
+    if not previews:
+        raise SystemExit(f'Nenhum arquivo .mp3 encontrado em {folder}')
+
+    start = time.perf_counter()
+    local = local_audio_features.extract_many(previews)
+    local_elapsed = time.perf_counter() - start
+
+    print(f'local: {len(local)}/{len(previews)} previews em {local_elapsed:.2f}s '
+          f'({local_elapsed / len(previews) * 1000:.1f} ms/preview)')
+
+    if offline:
+        return
+
+    client = ReccoBeatsClient()
+
+    start = time.perf_counter()
+    remote = client.extract_many(previews)
+    remote_elapsed = time.perf_counter() - start
+    client.close()
+
+    print(f'reccobeats: {len(remote)}/{len(previews)} previews em {remote_elapsed:.2f}s '
+          f'({remote_elapsed / len(previews) * 1000:.1f} ms/preview) | latência {client.latency_summary()}')
+
+    common = [track_id for track_id in local if track_id in remote]
+
+    if not common:
+        return
+
+    print('Erro absoluto médio (local vs. ReccoBeats):')
+    for field in FIELDS:
+        pairs = [(local[t][field], remote[t].get(field)) for t in common if remote[t].get(field) is not None]
+        if pairs:
+            mae = sum(abs(a - b) for a, b in pairs) / len(pairs)
+            print(f'{field:>17}: {mae:.4f}')
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,62 @@
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'dags'))
+
+from embed_parser import extract_preview_url_fast, extract_preview_url_soup  # noqa: E402
+
+
+def measure(extractor, pages, repeat):
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        for html in pages:
+            extractor(html)
+
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    per_page_ms = elapsed / (repeat * len(pages)) * 1000
+    return per_page_ms, peak / 1024
+
+
+def main():
+
+    """
+    Compara o extrator rápido do __NEXT_DATA__ com o BeautifulSoup em páginas de
+    embed salvas: python scripts/bench_next_data.py <pasta_com_html> [repeticoes]
+    """
+
+    folder = Path(sys.argv[1])
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    paths = sorted(folder.glob('*.html'))
+    pages = [p.read_text(encoding='utf-8') for p in paths]
+
+    if not pages:
+        raise SystemExit(f'Nenhum arquivo .html encontrado em {folder}')
+
+    # O extrator rápido assume que o primeiro audioPreview após "entity" é o da entidade
+    mismatches = [
+        path.name for path, html in zip(paths, pages)
+        if extract_preview_url_fast(html) != extract_preview_url_soup(html)
+    ]
+
+    if mismatches:
+        print(f'[WARN] Os extratores divergiram em {len(mismatches)} página(s): {", ".join(mismatches)}')
+
+    print(f'{len(pages)} páginas, {repeat} repetições')
+
+    for name, extractor in (('regex', extract_preview_url_fast), ('beautifulsoup', extract_preview_url_soup)):
+        per_page_ms, peak_kb = measure(extractor, pages, repeat)
+        print(f'{name:>14}: {per_page_ms:8.3f} ms/página | pico de memória {peak_kb:10.1f} KiB')
+
+
+if __name__ == '__main__':
+
+    main()
@@ -1,14 +1,25 @@
+import argparse
 import base64
 import configparser
 import hashlib
 import json
+import os
 import secrets
-from datetime import datetime
-from time import sleep
+import sys
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from time import sleep, time
+from zoneinfo import ZoneInfo
 
 import boto3
 import requests
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'dags'))
+
+from spotify_storage import append_to_manifest, encode_snapshot  # noqa: E402
+from spotify_token import SpotifyTokenManager  # noqa: E402
+
 
 class SpotifyScraper:
 
@@ -18,8 +29,32 @@ class SpotifyScraper:
         self.config.read('.env')
         self.client_id = self.config['SPOTIFY']['client_id']
         self.redirect_uri = 'http://localhost:3000'
+        self.session = requests.Session()
+        self._s3_client = None
+        self.token_manager = SpotifyTokenManager(
+            self._load_token,
+            lambda state: self._update_token(state['access_token'], state['refresh_token'], state['expires_at']),
+            client_id=self.client_id,
+            client_secret=self.config['SPOTIFY'].get('client_secret', '')
+        )
+
+    def _load_token(self):
+
+        spotify = self.config['SPOTIFY']
+        expires_at = spotify.get('expires_at')
 
-    def _update_token(self, access_token, refresh_token):
+        # Configurações antigas só têm a data do último token, válido por 1 hora
+        if not expires_at and spotify.get('last_date_token'):
+            last_date_token = datetime.strptime(spotify['last_date_token'], '%d/%m/%Y %H:%M:%S')
+            expires_at = (last_date_token + timedelta(hours=1)).timestamp()
+
+        return {
+            'access_token': spotify.get('access_token'),
+            'refresh_token': spotify.get('refresh_token'),
+            'expires_at': expires_at or 0
+        }
+
+    def _update_token(self, access_token, refresh_token, expires_at=None):
 
         if 'SPOTIFY' not in self.config:
             self.config['SPOTIFY'] = {}
@@ -28,6 +63,7 @@ class SpotifyScraper:
         self.config['SPOTIFY']['refresh_token'] = refresh_token
         self.config['SPOTIFY']['last_date_token'] = datetime.now().strftime(
             '%d/%m/%Y %H:%M:%S')
+        self.config['SPOTIFY']['expires_at'] = str(expires_at or time() + 3600)
 
         with open('.env', 'w') as f:
             self.config.write(f)
@@ -78,6 +114,7 @@ class SpotifyScraper:
         print('Access Token: ' + access_token)
 
         self._update_token(access_token, refresh_token)
+        self.token_manager.state = None
         return access_token
 
     def get_access_token(self):
@@ -89,59 +126,56 @@ class SpotifyScraper:
 
         return access_token
 
-    def renew_access_token(self):
+    def renew_access_token(self, force=False):
 
-        token_url = "https://accounts.spotify.com/api/token"
-        refresh_token = self.config['SPOTIFY']['refresh_token']
+        """
+        Retorna um access_token válido pelo SpotifyTokenManager, que só chama a API
+        quando o token atual está perto de expirar. Retorna None se o refresh falhar.
+        """
 
-        client_id = self.config['SPOTIFY']['client_id']
-        client_secret = self.config['SPOTIFY']['client_secret']
-        client_creds = f"{client_id}:{client_secret}"
-        client_creds_b64 = base64.b64encode(client_creds.encode()).decode()
+        try:
+            return self.token_manager.get_token(force=force)
+        except (RuntimeError, KeyError):
+            return None
 
-        print(client_creds_b64)
+    def _get_with_retry_after(self, url, max_retries=5, **kwargs):
 
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Basic {client_creds_b64}"
-        }
+        for attempt in range(max_retries + 1):
 
-        data = {
-            "grant_type": "refresh_token",
-            "refresh_token": refresh_token
-        }
-
-        response = requests.post(token_url, headers=headers, data=data)
+            response = self.session.get(url, timeout=(5, 30), **kwargs)
 
-        if response.status_code == 200:
+            if response.status_code != 429 and response.status_code < 500:
+                return response
 
-            access_token = response.json()['access_token']
-            new_refresh_token = response.json()['refresh_token']
+            if attempt == max_retries:
+                break
 
-            self._update_token(access_token, new_refresh_token)
+            wait = self._retry_after(response)
+            if wait is None:
+                wait = 2 ** attempt
 
-            return access_token
+            print(f'Status {response.status_code}, nova tentativa em {wait:.0f}s')
+            sleep(wait)
 
-        return None
+        response.raise_for_status()
+        return response
 
-    def _verify_valid_token(self):
+    @staticmethod
+    def _retry_after(response):
 
-        last_date_token = datetime.strptime(
-            self.config['SPOTIFY']['last_date_token'],
-            "%d/%m/%Y %H:%M:%S"
-        )
-        now_date = datetime.now()
-
-        time_active_token_in_minutes = round(
-            (
-                now_date - last_date_token
-            ).total_seconds() / 60
-        )
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
 
-        if time_active_token_in_minutes > 60:
-            return False
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
 
-        return True
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
 
     def get_tracks_history(self, unix_date):
 
@@ -149,10 +183,7 @@ class SpotifyScraper:
         limit = 50
         before = unix_date
 
-        if self._verify_valid_token():
-            access_token = self.config['SPOTIFY']['access_token']
-        else:
-            access_token = self.get_access_token()
+        access_token = self.get_access_token()
 
         params = {
             'limit': limit,
@@ -163,46 +194,101 @@ class SpotifyScraper:
             'Authorization': f'Bearer {access_token}'
         }
 
-        response = requests.get(url, params=params, headers=header)
+        response = self._get_with_retry_after(url, params=params, headers=header)
+        response_json = response.json()
 
-        if len(response.json()['items']) == 0:
+        if len(response_json['items']) == 0:
             return 0
 
-        before = int(response.json()['cursors']['before'])
+        before = int(response_json['cursors']['before'])
 
-        data = response.json()['items']
-
-        with open('resultado.json', 'w') as json_file:
-            json.dump(data, json_file, indent=4)
+        data = response_json['items']
 
         self.save_to_s3(data)
 
         return before
 
+    @property
+    def s3_client(self):
+
+        if self._s3_client is None:
+            self._s3_client = boto3.client(
+                's3',
+                aws_access_key_id=self.config['AWS']['AWS_ACCESS_KEY_ID'],
+                aws_secret_access_key=self.config['AWS']['AWS_SECRET_ACCESS_KEY'],
+                region_name=self.config['AWS']['AWS_REGION']
+            )
+
+        return self._s3_client
+
     def save_to_s3(self, data):
 
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=self.config['AWS']['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key=self.config['AWS']['AWS_SECRET_ACCESS_KEY'],
-            region_name=self.config['AWS']['AWS_REGION']
-        )
+        """
+        Salva a página no mesmo layout lido pela DAG: arquivos/YYYYMMDD/tracks_history_YYYYMMDD_HHMMSS.<formato>,
+        com a data da reprodução mais recente da página no fuso de São Paulo. O formato vem
+        de RAW_FORMAT/RAW_PROJECTION na seção [AWS] do .env.
+        """
 
         bucket_name = self.config['AWS']['S3_BUCKET_NAME']
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f'tracks_history_{timestamp}.json'
 
-        json_data = json.dumps(data, indent=4)
+        newest = max(item['played_at'] for item in data)
+        played_at = datetime.fromisoformat(newest.replace('Z', '+00:00'))
+        timestamp = played_at.astimezone(ZoneInfo('America/Sao_Paulo')).strftime('%Y%m%d_%H%M%S')
+
+        json_data, extension, content_type = encode_snapshot(
+            data,
+            self.config['AWS'].get('RAW_FORMAT', 'json'),
+            self.config['AWS'].getboolean('RAW_PROJECTION', False)
+        )
 
-        s3_client.put_object(
+        date_folder = timestamp.split('_')[0]
+        filename = f'arquivos/{date_folder}/tracks_history_{timestamp}{extension}'
+
+        response = self.s3_client.put_object(
             Bucket=bucket_name,
             Key=filename,
             Body=json_data,
-            ContentType='application/json'
+            ContentType=content_type
         )
 
+        append_to_manifest(self.s3_client, bucket_name, date_folder, filename, len(json_data), response['ETag'])
+
         print(f'Arquivo salvo no S3: {bucket_name}/{filename}')
 
+    def backfill(self, checkpoint_path, restart=False):
+
+        """
+        Percorre o histórico para trás pelo cursor `before`, salvando cada página no S3.
+
+        O último cursor é gravado em checkpoint_path após cada página, permitindo retomar
+        o backfill de onde parou.
+        """
+
+        checkpoint = {}
+
+        if not restart and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+
+        if checkpoint.get('done'):
+            print('Backfill já concluído. Use --restart para começar de novo.')
+            return
+
+        next_page = checkpoint.get('before') or int(round(datetime.now().timestamp() * 1000))
+        pages = checkpoint.get('pages', 0)
+
+        while next_page:
+
+            next_page = self.get_tracks_history(next_page)
+
+            if next_page:
+                pages += 1
+
+            with open(checkpoint_path, 'w') as f:
+                json.dump({'before': next_page, 'pages': pages, 'done': not next_page}, f)
+
+        print(f'Backfill concluído: {pages} páginas salvas.')
+
     def get_data(self, data):
 
         album_data = data['track']['album']
@@ -234,16 +320,15 @@ class SpotifyScraper:
 
 def main():
 
-    date_now = datetime.now()
-    date_now = int(round(date_now.timestamp() * 1000))
+    parser = argparse.ArgumentParser(description='Backfill do histórico de reproduções do Spotify para o S3')
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.json',
+                        help='arquivo com o último cursor processado')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignora o checkpoint e começa do momento atual')
+    args = parser.parse_args()
 
     spotify_scraper = SpotifyScraper()
-
-    next_page = date_now
-
-    while next_page:
-        next_page = spotify_scraper.get_tracks_history(next_page)
-        sleep(2)
+    spotify_scraper.backfill(args.checkpoint, restart=args.restart)
 
 
 if __name__ == '__main__':